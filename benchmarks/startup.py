@@ -0,0 +1,102 @@
+"""
+Measures the cold-start latency of the hot internal entry points of the kochi CLI.
+
+    $ python3 benchmarks/startup.py [-n REPEAT] [--budget-ms MS]
+
+Each entry point is run in a fresh interpreter with `-X importtime` against a temporary KOCHI_ROOT (machine "local").
+For each one, the median wall time and the median import time (sum of top-level imports reported by `-X importtime`)
+are shown with the slowest imports. Note that submodules lazily loaded by the CLI are not reported by `-X importtime`,
+but they are included in the wall time.
+If `--budget-ms` is given, exits with failure when the median wall time of any entry point exceeds the budget.
+"""
+
+import os
+import sys
+import re
+import argparse
+import statistics
+import subprocess
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from kochi import util
+
+entry_code = "import sys; from kochi.cli import cli; cli(sys.argv[1:], prog_name='kochi')"
+
+def entry_points(queue_name):
+    from kochi import job_queue
+    job = job_queue.Job(name="startup_benchmark", machine="local", project_name=None, queue=queue_name,
+                        dependencies=dict(), context=None, params=dict(), artifacts_conf=[], activate_script=[],
+                        build_conf=dict(), run_conf=dict(script=["true"]))
+    on_machine_cmd = dict(funcname="artifact_status_cmd", kwargs=dict())
+    return [
+        ("work"          , ["work", "-m", "local", "-q", queue_name + "_empty"]),
+        ("enqueue_aux"   , ["enqueue_aux", "-m", "local", util.serialize(job)]),
+        ("on_machine_aux", ["on_machine_aux", "-m", "local", util.serialize(on_machine_cmd)]),
+    ]
+
+importtime_regexp = re.compile(r"^import time:\s*(\d+)\s*\|\s*(\d+)\s*\|( *)(\S+)")
+
+def parse_importtime(stderr):
+    # top-level imports (not nested in other imports) and their cumulative time in us
+    imports = []
+    for line in stderr.splitlines():
+        m = importtime_regexp.match(line)
+        if m and len(m.group(3)) == 1:
+            imports.append((m.group(4), int(m.group(2))))
+    return imports
+
+def run_once(args, env):
+    t = time.perf_counter()
+    p = subprocess.run([sys.executable, "-X", "importtime", "-c", entry_code, *args], env=env,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, encoding="utf-8")
+    wall_time = time.perf_counter() - t
+    if p.returncode != 0:
+        raise Exception("'kochi {}' failed:\n{}".format(args[0], "\n".join(l for l in p.stderr.splitlines() if not l.startswith("import time:"))))
+    return wall_time, parse_importtime(p.stderr)
+
+def benchmark(name, args, env, repeat):
+    wall_times = []
+    import_times = []
+    slowest = dict()
+    for _ in range(repeat):
+        wall_time, imports = run_once(args, env)
+        wall_times.append(wall_time)
+        import_times.append(sum(t for _, t in imports) / 1e6)
+        for module, t in imports:
+            slowest[module] = max(slowest.get(module, 0), t)
+    wall_ms = statistics.median(wall_times) * 1000
+    import_ms = statistics.median(import_times) * 1000
+    print("{:<16} wall: {:8.1f} ms  imports: {:8.1f} ms".format(name, wall_ms, import_ms))
+    for module, t in sorted(slowest.items(), key=lambda x: -x[1])[:5]:
+        print("  {:<30} {:8.1f} ms".format(module, t / 1000))
+    return wall_ms
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup-time benchmark of the kochi CLI")
+    parser.add_argument("-n", "--repeat", type=int, default=10, help="Number of runs for each entry point")
+    parser.add_argument("--budget-ms", type=float, help="Maximum median wall time allowed for each entry point")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        with open(os.path.join(root, "conf.yaml"), "w") as f:
+            f.write("machines:\n  local:\n    work_dir: {}\n".format(root))
+        env = os.environ.copy()
+        env["KOCHI_ROOT"] = root
+        env.pop("KOCHI_DEFAULT_MACHINE", None)
+        env["PYTHONPATH"] = os.pathsep.join([os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."),
+                                             *([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])])
+        os.environ["KOCHI_ROOT"] = root
+        with util.cwd(root):
+            results = [(name, benchmark(name, cmd_args, env, args.repeat)) for name, cmd_args in entry_points("startup_benchmark")]
+
+    if args.budget_ms is not None:
+        over = [name for name, wall_ms in results if wall_ms > args.budget_ms]
+        if over:
+            print("Over the startup-time budget of {} ms: {}".format(args.budget_ms, ", ".join(over)), file=sys.stderr)
+            exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+import os
+
+# A set of active entity IDs (jobs or workers) represented as marker files in a directory.
+# Listing active entities costs O(#active) regardless of how many entities were created in the past.
+
+def add(dirpath, idx):
+    with open(os.path.join(dirpath, str(idx)), "w"):
+        pass
+
+def remove(dirpath, idx):
+    try:
+        os.remove(os.path.join(dirpath, str(idx)))
+    except FileNotFoundError:
+        pass
+
+def list_all(dirpath):
+    try:
+        return sorted([int(f) for f in os.listdir(dirpath) if f.isdigit()])
+    except FileNotFoundError:
+        return []
+
+def ensure_init(dirpath, legacy_active_ids_fn):
+    """
+    Creates the active set directory.
+    If it did not exist, entities found active by `legacy_active_ids_fn()` (e.g., a scan of old states) are added.
+    """
+    if not os.path.isdir(dirpath):
+        os.makedirs(dirpath, exist_ok=True)
+        for idx in legacy_active_ids_fn():
+            add(dirpath, idx)
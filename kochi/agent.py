@@ -0,0 +1,291 @@
+import os
+import sys
+import socket
+import struct
+import signal
+import time
+import shlex
+import getpass
+import tempfile
+import threading
+import subprocess
+
+from . import util
+from . import settings
+from . import config
+from . import ssh_connection
+
+# An optional long-lived process on the login node that runs kochi commands without starting a new Python interpreter.
+#
+# The agent listens on a unix domain socket on the login node, and clients connect to it through a stream-local
+# forwarding over the multiplexed ssh connection (so no process is spawned on the login node per command).
+# For each request, the agent forks a process, in which modules and the config are already loaded.
+#
+# Request : one serialized dict per connection (prefixed by its length), with `argv`, `env`, `cwd` and `input` (or `stop`)
+# Response: frames of (tag, length, payload); tag "1" for stdout, "2" for stderr, and "x" for the exit code
+request_header = struct.Struct("<I")
+frame_header = struct.Struct("<cI")
+
+def socket_filepath(machine):
+    return os.path.join(tempfile.gettempdir(), "kochi-agent-{}-{}.sock".format(getpass.getuser(), machine))
+
+# Server (on the login node)
+# -----------------------------------------------------------------------------
+
+def send_frame(conn, tag, payload):
+    conn.sendall(frame_header.pack(tag, len(payload)) + payload)
+
+def recv_exact(conn, n):
+    bs = []
+    while n > 0:
+        b = conn.recv(n)
+        if len(b) == 0:
+            raise EOFError
+        bs.append(b)
+        n -= len(b)
+    return b"".join(bs)
+
+def recv_request(conn):
+    length, = request_header.unpack(recv_exact(conn, request_header.size))
+    return util.deserialize(recv_exact(conn, length).decode())
+
+def run_request(req):
+    # in a forked process
+    from . import cli
+    if req.get("cwd"):
+        os.chdir(req["cwd"])
+    os.environ.update({k: str(v) for k, v in (req.get("env") or dict()).items() if v})
+    try:
+        cli.cli.main(args=req["argv"], prog_name="kochi")
+    except SystemExit as e:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(e.code if isinstance(e.code, int) else 1)
+    except BaseException as e:
+        print(e, file=sys.stderr, flush=True)
+        os._exit(1)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(0)
+
+def handle(conn):
+    # in a forked process for each connection
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    try:
+        req = recv_request(conn)
+    except (EOFError, OSError):
+        os._exit(0)
+    if req.get("stop"):
+        send_frame(conn, b"x", struct.pack("<i", 0))
+        conn.close()
+        os.kill(os.getppid(), signal.SIGTERM)
+        os._exit(0)
+    stdin_r, stdin_w = os.pipe()
+    stdout_r, stdout_w = os.pipe()
+    stderr_r, stderr_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        conn.close()
+        os.dup2(stdin_r, 0)
+        os.dup2(stdout_w, 1)
+        os.dup2(stderr_w, 2)
+        for fd in [stdin_r, stdin_w, stdout_r, stdout_w, stderr_r, stderr_w]:
+            os.close(fd)
+        sys.stdin = open(0, "r", closefd=False)
+        sys.stdout = open(1, "w", closefd=False)
+        sys.stderr = open(2, "w", closefd=False)
+        run_request(req)
+    for fd in [stdin_r, stdout_w, stderr_w]:
+        os.close(fd)
+    def feed_stdin():
+        # in a thread so that a command writing a lot before reading stdin does not block on the pipes
+        try:
+            with open(stdin_w, "wb") as f:
+                f.write((req.get("input") or "").encode())
+        except OSError:
+            pass
+    send_lock = threading.Lock()
+    def forward(fd, tag):
+        # if the client has gone, closing the pipe lets the command fail on write
+        try:
+            while True:
+                data = os.read(fd, 65536)
+                if len(data) == 0:
+                    break
+                with send_lock:
+                    send_frame(conn, tag, data)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+    threads = [threading.Thread(target=forward, args=(stdout_r, b"1")), threading.Thread(target=forward, args=(stderr_r, b"2")),
+               threading.Thread(target=feed_stdin)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    _, status = os.waitpid(pid, 0)
+    try:
+        send_frame(conn, b"x", struct.pack("<i", os.waitstatus_to_exitcode(status)))
+    except OSError:
+        pass
+    conn.close()
+    os._exit(0)
+
+def warm_up(machine):
+    from . import cli # noqa: F401
+    util.load_lazy_modules()
+    try:
+        config.root_config()
+    except BaseException:
+        # the config file may not exist on the login node
+        pass
+
+def serve(machine, **opts):
+    idle_timeout = opts.get("idle_timeout", 3600)
+    filepath = socket_filepath(machine)
+    warm_up(machine)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        # no window in which other users can connect to the socket
+        old_umask = os.umask(0o077)
+        try:
+            s.bind(filepath)
+        finally:
+            os.umask(old_umask)
+        os.chmod(filepath, 0o600)
+        s.listen()
+        s.settimeout(idle_timeout)
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda _signum, _frame: sys.exit(0))
+        try:
+            while True:
+                try:
+                    conn, _addr = s.accept()
+                except socket.timeout:
+                    return
+                conn.settimeout(None)
+                if os.fork() == 0:
+                    s.close()
+                    handle(conn)
+                conn.close()
+        finally:
+            os.remove(filepath)
+
+def wait_ready(filepath, **opts):
+    """
+    Waits for the agent to listen on the socket at `filepath` (a stale socket file may exist before it is bound).
+    """
+    timeout = opts.get("timeout", 10)
+    t_end = time.time() + timeout
+    while time.time() < t_end:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                s.connect(filepath)
+            return True
+        except OSError:
+            time.sleep(0.02)
+    return False
+
+def daemonize(filepath):
+    if os.fork() > 0:
+        # return to the client (`kochi agent start`) only after the agent gets ready,
+        # so that the first command does not find no agent and forget it
+        wait_ready(filepath)
+        os._exit(0)
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in [0, 1, 2]:
+        os.dup2(devnull, fd)
+
+# Client
+# -----------------------------------------------------------------------------
+
+def remote_socket_filepath(machine):
+    try:
+        with open(settings.agent_socket_cache_filepath(machine), "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def start(machine):
+    host = config.login_host(machine)
+    script = "kochi agent_aux -m {} --daemon".format(machine)
+    path = util.run_command_ssh(host, config.load_env_login_script(machine) + [script], cwd=config.work_dir(machine)).strip()
+    util.ensure_dir_exists(settings.agent_socket_cache_filepath(machine))
+    with open(settings.agent_socket_cache_filepath(machine), "w") as f:
+        f.write(path)
+    return path
+
+def forget(machine):
+    try:
+        os.remove(settings.agent_socket_cache_filepath(machine))
+    except FileNotFoundError:
+        pass
+
+def run_aux(remote_path, host, req, **opts):
+    sshflags = ssh_connection.sshflags(host)
+    local_path = os.path.join(tempfile.gettempdir(), "kochi-agent-client-{}-{}.sock".format(os.getpid(), threading.get_ident()))
+    forward_spec = "{}:{}".format(local_path, remote_path)
+    if subprocess.run(["ssh", *sshflags, "-O", "forward", "-L", forward_spec, host],
+                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(local_path)
+            payload = util.serialize(req).encode()
+            s.sendall(request_header.pack(len(payload)) + payload)
+            outputs = []
+            received = False
+            while True:
+                try:
+                    tag, length = frame_header.unpack(recv_exact(s, frame_header.size))
+                except EOFError:
+                    if received:
+                        raise Exception("Connection to the kochi agent on {} was lost.".format(host))
+                    # the request was not processed; the caller can safely retry it over ssh
+                    return None
+                received = True
+                payload = recv_exact(s, length)
+                if tag == b"x":
+                    return struct.unpack("<i", payload)[0], b"".join(outputs)
+                elif tag == b"1" and opts.get("capture"):
+                    outputs.append(payload)
+                elif tag == b"1":
+                    sys.stdout.buffer.write(payload)
+                    sys.stdout.buffer.flush()
+                elif not opts.get("capture"):
+                    sys.stderr.buffer.write(payload)
+                    sys.stderr.buffer.flush()
+    except OSError:
+        return None
+    finally:
+        subprocess.run(["ssh", *sshflags, "-O", "cancel", "-L", forward_spec, host], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if os.path.exists(local_path):
+            os.remove(local_path)
+
+def run(machine, script, **opts):
+    """
+    Runs a kochi command `script` through the agent on the login node of the machine.
+    Returns None if no agent is available, so that the caller can fall back to running it over ssh.
+    Otherwise, returns (exit code, stdout), where stdout is captured only if `capture` is specified.
+    """
+    remote_path = remote_socket_filepath(machine)
+    argv = shlex.split(script)
+    if not remote_path or machine == "local" or len(argv) == 0 or argv[0] != "kochi":
+        return None
+    req = dict(argv=argv[1:], env=opts.get("env"), cwd=config.work_dir(machine), input=opts.get("input"))
+    ret = run_aux(remote_path, config.login_host(machine), req, **opts)
+    if ret is None:
+        # the agent has gone (e.g., idle timeout)
+        forget(machine)
+    return ret
+
+def stop(machine):
+    remote_path = remote_socket_filepath(machine)
+    if remote_path:
+        run_aux(remote_path, config.login_host(machine), dict(stop=True))
+        forget(machine)
@@ -1,30 +1,99 @@
+from collections import namedtuple
 import os
+import glob
 import subprocess
 import shutil
 import time
 import string
+import multiprocessing
+import concurrent.futures
 
 from . import util
 from . import settings
 from . import stats
 from . import project
+from . import config
+from . import blob
+from . import ssh_connection
 
-def artifact_path(machine, worker_id, project_name, relative_path):
-    return os.path.join(settings.artifacts_dirpath(machine, project_name, worker_id), machine, relative_path)
+# Artifacts of jobs are published asynchronously:
+# 1. When a job finishes, its artifacts are copied to a spool entry (a directory per job) on the machine
+# 2. A publisher (only one at a time per machine, elected by flock) moves all spooled artifacts of a project
+#    to its clone of the artifact branch and pushes them as one commit
+# The publisher is forked by the worker after spooling, so the worker can start the next job without waiting for git.
+#
+# Large artifacts ("large_file" type, or "file" type larger than `large_threshold`) are stored in the blob store of the project,
+# and only a pointer file (`<dest>.kochi-object`) is committed. `kochi artifact sync` fetches the content next to pointer files.
+pointer_suffix = ".kochi-object"
+fetched_suffix = ".kochi-fetched"
+
+PendingArtifact = namedtuple("PendingArtifact", ["job_id", "job_name", "project", "git_remote", "queued_time"])
+
+publishers = []
+
+# Set in forked slot processes of a worker, which exit without waiting for publishers;
+# their parent worker starts publishers instead (see worker.slot_worker_loop)
+defer_publish = False
 
 def save(machine, worker_id, job):
-    ensure_init_worker(machine, worker_id, job.context)
+    entry_dirpath = settings.artifacts_spool_entry_dirpath(machine, job.id)
+    tmp_dirpath = entry_dirpath + ".tmp"
+    os.makedirs(tmp_dirpath, exist_ok=True)
     for artifact_conf in job.artifacts_conf:
-        dest_path = string.Template(artifact_path(machine, worker_id, job.project_name, artifact_conf["dest"])).substitute(job.params)
+        dest = string.Template(artifact_conf["dest"]).substitute(job.params)
+        dest_path = os.path.join(tmp_dirpath, "files", machine, dest)
         util.ensure_dir_exists(dest_path)
         if artifact_conf["type"] == "stdout":
             shutil.copy2(settings.job_log_filepath(machine, job.id), dest_path)
         elif artifact_conf["type"] == "stats":
             with open(dest_path, "w") as f:
                 stats.show_job_detail(machine, job.id, stdout=f)
-        elif artifact_conf["type"] == "file":
+        elif artifact_conf["type"] == "file" and not is_large(artifact_conf):
             shutil.copy2(artifact_conf["src"], dest_path)
-    push_loop(machine, worker_id, job.context)
+        elif artifact_conf["type"] in ["file", "large_file"]:
+            write_pointer(dest_path + pointer_suffix, blob.put_file(job.project_name, artifact_conf["src"]),
+                          os.path.getsize(artifact_conf["src"]))
+    pending = PendingArtifact(job.id, job.name, job.project_name, job.context.git_remote, int(time.time()))
+    with open(os.path.join(tmp_dirpath, "pending.txt"), "w") as f:
+        f.write(util.serialize(pending))
+    # publishers ignore incomplete entries
+    os.rename(tmp_dirpath, entry_dirpath)
+    if not defer_publish:
+        publish_async(machine)
+
+def is_large(artifact_conf):
+    if "large_threshold" in artifact_conf:
+        return os.path.getsize(artifact_conf["src"]) > util.parse_size(artifact_conf["large_threshold"])
+    else:
+        return False
+
+def write_pointer(filepath, blob_hash, size):
+    with open(filepath, "w") as f:
+        print("kochi-object", file=f)
+        print("sha256 {}".format(blob_hash), file=f)
+        print("size {}".format(size), file=f)
+
+def read_pointer(filepath):
+    with open(filepath, "r") as f:
+        fields = dict([line.split() for line in f.read().splitlines()[1:] if line])
+    return fields["sha256"], int(fields["size"])
+
+def list_pending(machine):
+    pendings = []
+    try:
+        entries = os.listdir(settings.artifacts_spool_dirpath(machine))
+    except FileNotFoundError:
+        return pendings
+    for entry in entries:
+        if entry.endswith(".tmp"):
+            continue
+        try:
+            with open(os.path.join(settings.artifacts_spool_dirpath(machine), entry, "pending.txt"), "r") as f:
+                pendings.append(util.deserialize(f.read()))
+        except FileNotFoundError:
+            # already published
+            pass
+    return sorted(pendings, key=lambda p: p.job_id)
 
 def try_push(machine):
     branch = settings.artifacts_branch(machine)
@@ -37,28 +106,87 @@ def try_push(machine):
     else:
         return True
 
-def push_loop(machine, worker_id, ctx):
+def push_loop(machine, dirpath, commit_msg):
     max_retry = 20
     retry_count = 0
-    with util.cwd(settings.artifacts_dirpath(machine, ctx.project, worker_id)):
-        commit_msg = "[kochi] add artifact on {}".format(machine)
+    with util.cwd(dirpath):
         subprocess.run(["git", "config", "user.name", "kochi"], check=True)
         subprocess.run(["git", "config", "user.email", "<>"], check=True)
         subprocess.run(["git", "add", "--all"], check=True)
-        subprocess.run(["git", "commit", "-q", "-m", commit_msg], check=True)
+        # nothing may be changed if the artifacts were committed by a publisher that failed to remove spool entries
+        if subprocess.run(["git", "diff", "--cached", "--quiet"]).returncode != 0:
+            subprocess.run(["git", "commit", "-q", "-m", commit_msg], check=True)
         while not try_push(machine):
             if retry_count == max_retry:
                 raise Exception("Could not push artifacts (max_retry={})".format(max_retry))
             retry_count += 1
             time.sleep(1)
 
-def ensure_init_worker(machine, worker_id, ctx):
-    dirpath = settings.artifacts_dirpath(machine, ctx.project, worker_id)
+def ensure_init_publisher(machine, project_name, git_remote):
+    dirpath = settings.artifacts_publisher_dirpath(machine, project_name)
     if not os.path.isdir(dirpath):
-        git_remote = ctx.git_remote if ctx.git_remote else settings.project_artifact_git_dirpath(ctx.project)
+        # borrow objects from the bare repository on the machine via git alternates
+        artifact_git_dirpath = settings.project_artifact_git_dirpath(project_name)
         branch = settings.artifacts_branch(machine)
-        subprocess.run(["git", "clone", "--recursive", "-q", "--depth=1", "-b", branch, "file://" + git_remote, dirpath], check=True)
-    os.makedirs(artifact_path(machine, worker_id, ctx.project, "."), exist_ok=True)
+        if git_remote:
+            subprocess.run(["git", "clone", "--recursive", "-q", "--reference-if-able", artifact_git_dirpath, "-b", branch, git_remote, dirpath], check=True)
+        else:
+            subprocess.run(["git", "clone", "--recursive", "-q", "--shared", "-b", branch, artifact_git_dirpath, dirpath], check=True)
+    return dirpath
+
+def publish_pending(machine, pendings):
+    """
+    Publishes spooled artifacts of the same project as one commit.
+    """
+    dirpath = ensure_init_publisher(machine, pendings[0].project, pendings[0].git_remote)
+    for p in pendings:
+        src_dirpath = os.path.join(settings.artifacts_spool_entry_dirpath(machine, p.job_id), "files")
+        if os.path.isdir(src_dirpath):
+            shutil.copytree(src_dirpath, dirpath, dirs_exist_ok=True)
+    job_ids = ", ".join([str(p.job_id) for p in pendings])
+    push_loop(machine, dirpath, "[kochi] add artifacts of jobs {} on {}".format(job_ids, machine))
+    for p in pendings:
+        shutil.rmtree(settings.artifacts_spool_entry_dirpath(machine, p.job_id))
+
+def publish(machine, blocking=False):
+    """
+    Publishes all spooled artifacts on the machine.
+    If another publisher is running, returns False immediately (or waits for it if `blocking`);
+    artifacts spooled before this call are published by that publisher.
+    """
+    util.ensure_dir_exists(settings.artifacts_publisher_lock_filepath(machine))
+    while True:
+        with util.flock(settings.artifacts_publisher_lock_filepath(machine), blocking=blocking) as locked:
+            if not locked:
+                return False
+            pendings = list_pending(machine)
+            for project_name in sorted(set([p.project for p in pendings])):
+                publish_pending(machine, [p for p in pendings if p.project == project_name])
+        # artifacts may have been spooled after listing while others could not get the lock
+        if len(list_pending(machine)) == 0:
+            return True
+
+def publish_detached(machine):
+    # in a forked child process, which leaves the worker's process group so that
+    # signals to cancel jobs do not interrupt git commands in the publisher clone
+    os.setsid()
+    publish(machine)
+
+def publish_async(machine):
+    global publishers
+    publishers = [p for p in publishers if p.is_alive()]
+    p = multiprocessing.get_context("fork").Process(target=publish_detached, args=(machine,))
+    p.start()
+    publishers.append(p)
+
+def wait_publishers():
+    for p in publishers:
+        p.join()
+
+def is_publishing(machine):
+    util.ensure_dir_exists(settings.artifacts_publisher_lock_filepath(machine))
+    with util.flock(settings.artifacts_publisher_lock_filepath(machine), blocking=False) as locked:
+        return not locked
 
 def get_artifact_worktree():
     for line in subprocess.run(["git", "worktree", "list"], stdout=subprocess.PIPE, encoding="utf-8", check=True).stdout.strip().split("\n"):
@@ -99,10 +227,98 @@ def init(new_worktree_path):
         subprocess.run(["git", "reset", "--hard"], check=True)
         subprocess.run(["git", "commit", "--allow-empty", "-m", "[kochi] create an artifact branch"], check=True)
 
-def sync(machine):
+def fetch_large_artifact(machine, blob_dirpath, pointer_filepath):
+    """
+    Fetches the content of a large artifact next to the pointer file.
+    The hash of the fetched content is recorded in a sidecar file (`.kochi-fetched`) to tell whether it is up to date.
+    A partially fetched file (`.<hash>.part`) is resumed from where it was left.
+    """
+    dest_path = pointer_filepath[:-len(pointer_suffix)]
+    blob_hash, size = read_pointer(pointer_filepath)
+    fetched_filepath = dest_path + fetched_suffix
+    if os.path.isfile(dest_path) and os.path.getsize(dest_path) == size:
+        try:
+            with open(fetched_filepath, "r") as f:
+                fetched_hash = f.read().strip()
+        except FileNotFoundError:
+            # fetched by an older version of kochi
+            fetched_hash = blob.compute_file_hash(dest_path)
+            if fetched_hash == blob_hash:
+                write_fetched_hash(fetched_filepath, blob_hash)
+        if fetched_hash == blob_hash:
+            return False
+    # partial files of other versions of the content cannot be resumed
+    part_path = "{}.{}.part".format(dest_path, blob_hash)
+    for p in glob.glob(glob.escape(dest_path) + ".*.part") + [dest_path + ".part"]:
+        if p != part_path and os.path.isfile(p):
+            os.remove(p)
+    src_path = os.path.join(blob_dirpath, blob_hash[:2], blob_hash[2:])
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    if offset > size:
+        os.remove(part_path)
+        offset = 0
+    if offset < size:
+        with open(part_path, "ab") as f:
+            if machine == "local":
+                with open(src_path, "rb") as src:
+                    src.seek(offset)
+                    shutil.copyfileobj(src, f)
+            else:
+                host = config.login_host(machine)
+                subprocess.run("ssh -o LogLevel=QUIET {} {} 'tail -c +{} {}'".format(ssh_connection.sshflags_str(host), host, offset + 1, src_path),
+                               shell=True, executable="/bin/bash", stdout=f, check=True)
+    if blob.compute_file_hash(part_path) != blob_hash:
+        os.remove(part_path)
+        raise Exception("Checksum mismatch for large artifact {}".format(dest_path))
+    os.replace(part_path, dest_path)
+    write_fetched_hash(fetched_filepath, blob_hash)
+    return True
+
+def write_fetched_hash(filepath, blob_hash):
+    with open(filepath, "w") as f:
+        print(blob_hash, file=f)
+
+def exclude_fetched(pointer_filepaths):
+    """
+    Adds fetched contents (and their sidecar and partial files) to the git exclude of the worktree,
+    so that they are not committed to the artifact branch.
+    """
+    exclude_filepath = subprocess.run(["git", "rev-parse", "--git-path", "info/exclude"], stdout=subprocess.PIPE, encoding="utf-8", check=True).stdout.strip()
+    try:
+        with open(exclude_filepath, "r") as f:
+            excluded = set(f.read().splitlines())
+    except FileNotFoundError:
+        excluded = set()
+    patterns = ["*" + fetched_suffix]
+    for p in pointer_filepaths:
+        dest = "/" + os.path.relpath(p[:-len(pointer_suffix)]).replace(os.sep, "/")
+        patterns.extend([dest, dest + ".*.part"])
+    new_patterns = [p for p in patterns if p not in excluded]
+    if len(new_patterns) > 0:
+        util.ensure_dir_exists(exclude_filepath)
+        with open(exclude_filepath, "a") as f:
+            for p in new_patterns:
+                print(p, file=f)
+
+def fetch_large_artifacts(machine, project_name, jobs):
+    # pointers of other machines refer to their own blob stores
+    pointer_filepaths = []
+    for dirpath, dirnames, filenames in os.walk(os.path.join(".", machine)):
+        pointer_filepaths.extend([os.path.abspath(os.path.join(dirpath, f)) for f in filenames if f.endswith(pointer_suffix)])
+    if len(pointer_filepaths) == 0:
+        return
+    exclude_fetched(pointer_filepaths)
+    blob_dirpath = project.blob_dirpath(machine, project_name)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(fetch_large_artifact, machine, blob_dirpath, p) for p in pointer_filepaths]
+        n_fetched = sum([1 if f.result() else 0 for f in futures])
+    print("Fetched {} large artifacts ({} up to date).".format(n_fetched, len(pointer_filepaths) - n_fetched))
+
+def sync(machine, jobs=8):
     worktree_path = get_artifact_worktree()
     if not worktree_path:
         raise Exception("Please run 'kochi artifact init <git_worktree_path>'.")
+    project_name = project.project_name_of_cwd()
     with util.cwd(worktree_path):
         try:
             subprocess.run(["git", "checkout", "-q", settings.artifacts_branch(machine)], check=True)
@@ -110,6 +326,7 @@ def sync(machine):
         finally:
             subprocess.run(["git", "checkout", "-q", settings.artifacts_master_branch()], check=True)
         subprocess.run(["git", "merge", "-X", "theirs", "--no-edit", settings.artifacts_branch(machine)], check=True)
+        fetch_large_artifacts(machine, project_name, jobs)
 
 def discard(machine):
     worktree_path = get_artifact_worktree()
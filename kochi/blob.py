@@ -0,0 +1,48 @@
+import os
+import hashlib
+import shutil
+
+from . import util
+from . import settings
+
+def compute_hash(data):
+    return hashlib.sha256(data.encode()).hexdigest()
+
+def put(project_name, data):
+    """
+    Stores `data` (str) in the content-addressed store of the project and returns its hash.
+    The same content is written only once.
+    """
+    blob_hash = compute_hash(data)
+    filepath = settings.project_blob_filepath(project_name, blob_hash)
+    if not os.path.isfile(filepath):
+        util.ensure_dir_exists(filepath)
+        tmp_filepath = "{}.tmp.{}.{}".format(filepath, os.uname()[1], os.getpid())
+        with open(tmp_filepath, "w", encoding="utf-8", newline="") as f:
+            f.write(data)
+        os.replace(tmp_filepath, filepath)
+    return blob_hash
+
+def compute_file_hash(filepath):
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def put_file(project_name, src_filepath):
+    """
+    Stores the content of the file at `src_filepath` and returns its hash.
+    """
+    blob_hash = compute_file_hash(src_filepath)
+    filepath = settings.project_blob_filepath(project_name, blob_hash)
+    if not os.path.isfile(filepath):
+        util.ensure_dir_exists(filepath)
+        tmp_filepath = "{}.tmp.{}.{}".format(filepath, os.uname()[1], os.getpid())
+        shutil.copyfile(src_filepath, tmp_filepath)
+        os.replace(tmp_filepath, filepath)
+    return blob_hash
+
+def get(project_name, blob_hash):
+    with open(settings.project_blob_filepath(project_name, blob_hash), "r", encoding="utf-8", newline="") as f:
+        return f.read()
@@ -0,0 +1,227 @@
+import os
+import re
+import sys
+import json
+import time
+import stat
+import shutil
+import tarfile
+import tempfile
+import functools
+import urllib.request
+import urllib.error
+import http.server
+
+from . import blob
+
+# Relocatable binary bundles of install prefixes, which are exchanged between machines of the same class.
+#
+# A bundle store is either a plain directory or a URL of a file server (e.g., `kochi bundle serve`), in which
+# a bundle of an installation is saved as `<machine class>/<fingerprint>.tar.gz` with its metadata `.json`.
+# The metadata (written last) records the checksum of the archive and the install prefixes at the time of export,
+# which are replaced with the prefixes on the importing machine.
+
+def archive_path(machine_class, fingerprint):
+    return "{}/{}.tar.gz".format(machine_class, fingerprint)
+
+def metadata_path(machine_class, fingerprint):
+    return "{}/{}.json".format(machine_class, fingerprint)
+
+# Bundle store
+# -----------------------------------------------------------------------------
+
+def is_url(store):
+    return store.startswith("http://") or store.startswith("https://")
+
+def store_get(store, path, filepath):
+    """
+    Copies the file at `path` in the store to `filepath`. Returns False if not found.
+    """
+    if is_url(store):
+        try:
+            with urllib.request.urlopen("{}/{}".format(store.rstrip("/"), path)) as res:
+                with open(filepath, "wb") as f:
+                    shutil.copyfileobj(res, f)
+            return True
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+    else:
+        try:
+            shutil.copyfile(os.path.join(store, path), filepath)
+            return True
+        except FileNotFoundError:
+            return False
+
+def store_put(store, path, filepath):
+    if is_url(store):
+        with open(filepath, "rb") as f:
+            req = urllib.request.Request("{}/{}".format(store.rstrip("/"), path), data=f, method="PUT",
+                                         headers={"Content-Length": str(os.path.getsize(filepath))})
+            urllib.request.urlopen(req).close()
+    else:
+        dest_filepath = os.path.join(store, path)
+        os.makedirs(os.path.dirname(dest_filepath), exist_ok=True)
+        tmp_filepath = "{}.tmp.{}.{}".format(dest_filepath, os.uname()[1], os.getpid())
+        shutil.copyfile(filepath, tmp_filepath)
+        os.replace(tmp_filepath, dest_filepath)
+
+def store_exists(store, path):
+    if is_url(store):
+        try:
+            urllib.request.urlopen(urllib.request.Request("{}/{}".format(store.rstrip("/"), path), method="HEAD")).close()
+            return True
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+    else:
+        return os.path.isfile(os.path.join(store, path))
+
+# Relocation
+# -----------------------------------------------------------------------------
+
+def relocate_binary(data, old, new):
+    # paths in binaries are replaced within null-terminated strings, which are padded to keep offsets
+    if len(new) > len(old):
+        raise Exception("The new prefix {} is longer than {}, which cannot be relocated in binary files.".format(new.decode(), old.decode()))
+    padding = len(old) - len(new)
+    def replace(m):
+        s = m.group(0)
+        return s.replace(old, new) + b"\0" * (padding * s.count(old))
+    return re.sub(re.escape(old) + rb"[^\0]*\0", replace, data)
+
+def prefix_replacements(metadata, prefix_dir, dep_prefixes):
+    replacements = {metadata["prefix"]: prefix_dir}
+    for k, path in metadata["dep_prefixes"].items():
+        if k in dep_prefixes:
+            replacements[path] = dep_prefixes[k]
+    return replacements
+
+def relocate_str(s, replacements):
+    for old, new in sorted(replacements.items(), key=lambda x: -len(x[0])):
+        s = s.replace(old, new)
+    return s
+
+def relocate(dirpath, replacements):
+    """
+    Replaces paths in `replacements` ({old path: new path}) in all files and symlinks under `dirpath`.
+    """
+    replacements = [(old.encode(), new.encode()) for old, new in sorted(replacements.items(), key=lambda x: -len(x[0])) if old != new]
+    if len(replacements) == 0:
+        return
+    for root, dirs, files in os.walk(dirpath):
+        for name in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            filepath = os.path.join(root, name)
+            if os.path.islink(filepath):
+                target = os.readlink(filepath).encode()
+                for old, new in replacements:
+                    target = target.replace(old, new)
+                os.remove(filepath)
+                os.symlink(target.decode(), filepath)
+                continue
+            with open(filepath, "rb") as f:
+                data = f.read()
+            if not any(old in data for old, _ in replacements):
+                continue
+            is_binary = b"\0" in data
+            for old, new in replacements:
+                data = relocate_binary(data, old, new) if is_binary else data.replace(old, new)
+            mode = os.stat(filepath).st_mode
+            os.chmod(filepath, mode | stat.S_IWUSR)
+            with open(filepath, "r+b") as f:
+                f.write(data)
+                f.truncate()
+            os.chmod(filepath, mode)
+
+# Export/Import
+# -----------------------------------------------------------------------------
+
+def export(store, machine_class, fingerprint, prefix_dir, dep_prefixes, **opts):
+    """
+    Saves the install prefix in the store unless it already exists. Returns False if it exists.
+    `dep_prefixes` is a dict of the prefixes of dependencies ({env var name: path}).
+    The installation state (`state`) is saved in the metadata.
+    """
+    if store_exists(store, metadata_path(machine_class, fingerprint)):
+        return False
+    excludes = opts.get("excludes", [])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        archive_filepath = os.path.join(tmpdir, "bundle.tar.gz")
+        with tarfile.open(archive_filepath, "w:gz") as tar:
+            tar.add(prefix_dir, arcname=".", filter=lambda ti: None if os.path.basename(ti.name) in excludes else ti)
+        metadata = dict(machine_class=machine_class, fingerprint=fingerprint, prefix=prefix_dir, dep_prefixes=dep_prefixes,
+                        sha256=blob.compute_file_hash(archive_filepath), exported_time=time.time(), state=opts.get("state"))
+        metadata_filepath = os.path.join(tmpdir, "bundle.json")
+        with open(metadata_filepath, "w") as f:
+            json.dump(metadata, f)
+        store_put(store, archive_path(machine_class, fingerprint), archive_filepath)
+        store_put(store, metadata_path(machine_class, fingerprint), metadata_filepath)
+    return True
+
+def extract(archive_filepath, dirpath):
+    with tarfile.open(archive_filepath, "r:gz") as tar:
+        if hasattr(tarfile, "tar_filter"):
+            # absolute symlinks (e.g., to the prefixes of dependencies) are allowed, unlike the "data" filter
+            tar.extractall(dirpath, filter="tar")
+        else:
+            tar.extractall(dirpath)
+
+def import_(store, machine_class, fingerprint, prefix_dir, dep_prefixes):
+    """
+    Extracts the bundle into `prefix_dir` and relocates it.
+    Returns the metadata of the bundle, or None if the bundle is not in the store.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        metadata_filepath = os.path.join(tmpdir, "bundle.json")
+        if not store_get(store, metadata_path(machine_class, fingerprint), metadata_filepath):
+            return None
+        with open(metadata_filepath, "r") as f:
+            metadata = json.load(f)
+        archive_filepath = os.path.join(tmpdir, "bundle.tar.gz")
+        if not store_get(store, archive_path(machine_class, fingerprint), archive_filepath):
+            return None
+        if blob.compute_file_hash(archive_filepath) != metadata["sha256"]:
+            raise Exception("Checksum mismatch for bundle {} in {}.".format(archive_path(machine_class, fingerprint), store))
+        os.makedirs(prefix_dir, exist_ok=True)
+        extract(archive_filepath, prefix_dir)
+    relocate(prefix_dir, prefix_replacements(metadata, prefix_dir, dep_prefixes))
+    return metadata
+
+# File server
+# -----------------------------------------------------------------------------
+
+class BundleRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def do_PUT(self):
+        filepath = self.translate_path(self.path)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        tmp_filepath = "{}.tmp.{}".format(filepath, os.getpid())
+        remaining = int(self.headers["Content-Length"])
+        with open(tmp_filepath, "wb") as f:
+            while remaining > 0:
+                data = self.rfile.read(min(remaining, 1 << 20))
+                if len(data) == 0:
+                    break
+                f.write(data)
+                remaining -= len(data)
+        if remaining > 0:
+            os.remove(tmp_filepath)
+            self.send_error(400, "Incomplete upload")
+            return
+        os.replace(tmp_filepath, filepath)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+def serve(dirpath, port, bind="127.0.0.1"):
+    # Uploads are not authenticated and the bundles contain binaries to be executed, so listen only on
+    # the loopback interface by default (e.g., to be reached through ssh port forwarding)
+    os.makedirs(dirpath, exist_ok=True)
+    handler = functools.partial(BundleRequestHandler, directory=dirpath)
+    with http.server.ThreadingHTTPServer((bind, port), handler) as server:
+        print("Serving bundles in {} at http://{}:{}/".format(dirpath, bind if bind else os.uname()[1], port), file=sys.stderr, flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -11,18 +11,22 @@ import click
 from . import util
 from . import settings
 from . import config
-from . import stats
-from . import worker
-from . import job_queue
-from . import job_manager
-from . import context
-from . import project
-from . import sshd
-from . import installer
-from . import reverse_shell
-from . import job_config
-from . import artifact
-from . import ssh_forward
+
+# Submodules are loaded on first use, so that each command imports only what it uses (see benchmarks/startup.py)
+stats         = util.lazy_import(__package__ + ".stats")
+worker        = util.lazy_import(__package__ + ".worker")
+job_queue     = util.lazy_import(__package__ + ".job_queue")
+job_manager   = util.lazy_import(__package__ + ".job_manager")
+context       = util.lazy_import(__package__ + ".context")
+project       = util.lazy_import(__package__ + ".project")
+sshd          = util.lazy_import(__package__ + ".sshd")
+installer     = util.lazy_import(__package__ + ".installer")
+reverse_shell = util.lazy_import(__package__ + ".reverse_shell")
+job_config    = util.lazy_import(__package__ + ".job_config")
+artifact      = util.lazy_import(__package__ + ".artifact")
+ssh_forward   = util.lazy_import(__package__ + ".ssh_forward")
+agent         = util.lazy_import(__package__ + ".agent")
+bundle        = util.lazy_import(__package__ + ".bundle")
 
 def ensure_init():
     sshd.ensure_init()
@@ -33,8 +37,19 @@ def ensure_init_machine(machine):
     job_queue.ensure_init(machine)
 
 def run_on_login_node(machine, script, **opts):
-    util.run_command_ssh_interactive(config.login_host(machine), config.load_env_login_script(machine) + [script],
-                                     cwd=config.work_dir(machine), env=opts.get("env"))
+    """
+    Returns the exit code of `script`.
+    """
+    if not opts.get("interactive"):
+        ret = agent.run(machine, script, input=opts.get("input"), env=opts.get("env"))
+        if ret is not None:
+            return ret[0]
+    if opts.get("input") is not None:
+        return util.run_command_ssh_input(config.login_host(machine), config.load_env_login_script(machine) + [script], opts.get("input"),
+                                   cwd=config.work_dir(machine), env=opts.get("env")).returncode
+    else:
+        return util.run_command_ssh_interactive(config.login_host(machine), config.load_env_login_script(machine) + [script],
+                                                cwd=config.work_dir(machine), env=opts.get("env")).returncode
 
 machine_option = click.option("-m", "--machine", metavar="MACHINE", required=True, help="Machine name", envvar="KOCHI_DEFAULT_MACHINE",
                               callback=lambda _c, _p, v: (ensure_init_machine(v), v)[-1])
@@ -112,7 +127,7 @@ def alloc_cmd(machine, queue, nodes, duplicates, time_limit, follow, blocking):
         raise click.UsageError("Please specify NODES_SPEC with --nodes (-n).")
     args = AllocArgs(queue, list(nodes), duplicates, time_limit, follow, blocking,
                      config.load_env_machine_script(machine), config.alloc_script(machine))
-    run_on_login_node(machine, "kochi alloc_aux -m {} {}".format(machine, util.serialize(args)))
+    run_on_login_node(machine, "kochi alloc_aux -m {} {}".format(machine, util.serialize(args)), interactive=follow)
 
 @cli.command(name="alloc_aux", hidden=True)
 @machine_option
@@ -174,6 +189,14 @@ def get_dependencies_recursively(deps, machine):
     get_dependencies_recursively_aux(deps, machine, deps_acc)
     return deps_acc
 
+def parse_resources(resources, params):
+    resources = {k: string.Template(v).substitute(params) if isinstance(v, str) else v for k, v in resources.items()}
+    if "cores" in resources:
+        resources["cores"] = int(resources["cores"])
+    if "memory" in resources:
+        resources["memory"] = util.parse_size(resources["memory"])
+    return resources
+
 def create_job(machine, queue, with_context, dependency, name, git_remote, commands):
     if len(commands) > 0 and pathlib.Path(commands[0]).suffix in [".yaml", ".yml"]:
         with_context = True
@@ -186,11 +209,13 @@ def create_job(machine, queue, with_context, dependency, name, git_remote, comma
             name = string.Template(job_config.default_name(commands[0], machine)).substitute(params)
         if not queue:
             queue = string.Template(job_config.default_queue(commands[0], machine)).substitute(params)
+        resources = parse_resources(job_config.resources(commands[0], machine), params)
     else:
         deps = parse_dependencies(dependency)
         params = dict()
         build_conf = dict()
         run_conf = dict(script=[subprocess.list2cmdline(list(commands))] if len(commands) > 0 else [])
+        resources = dict()
 
     if not name:
         name = "ANON"
@@ -200,9 +225,9 @@ def create_job(machine, queue, with_context, dependency, name, git_remote, comma
     if with_context:
         if not util.is_inside_git_dir():
             raise click.UsageError("--with-context (-c) option must be used inside a git directory.")
-        if not git_remote:
-            project.sync(machine)
         ctx = context.create(git_remote)
+        if not git_remote:
+            project.sync(machine, ctx.reference)
         project_name = project.project_name_of_cwd()
     else:
         ctx = None
@@ -214,7 +239,7 @@ def create_job(machine, queue, with_context, dependency, name, git_remote, comma
     activate_script = sum([config.recipe_activate_script(d, r) for d, r in rec_deps.items()], [])
 
     return job_queue.Job(name, machine, project_name, queue, rec_deps, ctx, params,
-                         [], activate_script, build_conf, run_conf)
+                         [], activate_script, build_conf, run_conf, resources)
 
 @cli.command(name="enqueue", context_settings=dict(ignore_unknown_options=True))
 @machine_option
@@ -240,14 +265,33 @@ def enqueue_cmd(click_ctx, machine, queue, with_context, dependency, name, git_r
 
 @cli.command(name="enqueue_aux", hidden=True)
 @machine_option
+@click.option("-w", "--wait", is_flag=True, default=False, help="Wait for the job to finish (fails if the job does not succeed)")
 @click.argument("job_serialized", required=True)
-def enqueue_aux_cmd(machine, job_serialized):
+def enqueue_aux_cmd(machine, wait, job_serialized):
     """
     For internal use only.
     """
     job = util.deserialize(job_serialized)
     job_enqueued = job_queue.push(job)
     click.secho("Job {} was submitted to queue '{}' on machine '{}'.".format(job_enqueued.id, job.queue, machine), fg="blue")
+    if wait and job_manager.wait(machine, job_enqueued.id) != job_manager.RunningState.TERMINATED:
+        exit(1)
+
+def enqueue_jobs(machine, jobs):
+    jobs_enqueued = job_queue.push_many(jobs)
+    for job, job_enqueued in zip(jobs, jobs_enqueued):
+        click.secho("Job {} was submitted to queue '{}' on machine '{}'.".format(job_enqueued.id, job.queue, machine), fg="blue")
+
+@cli.command(name="enqueue_bulk_aux", hidden=True)
+@machine_option
+def enqueue_bulk_aux_cmd(machine):
+    """
+    For internal use only.
+    A serialized list of jobs is given from stdin.
+    Objects shared by the jobs (e.g., the context) are serialized only once in the list.
+    """
+    jobs = util.deserialize(sys.stdin.read().strip())
+    enqueue_jobs(machine, jobs)
 
 # interact
 # -----------------------------------------------------------------------------
@@ -275,7 +319,7 @@ def interact_cmd(click_ctx, machine, queue, with_context, dependency, git_remote
     else:
         with ssh_forward.reverse_forward(config.login_host(machine)) as remote_port:
             args = InteractArgs(job, remote_port, forward_port)
-            run_on_login_node(machine, "kochi interact_aux -m {} {}".format(machine, util.serialize(args)))
+            run_on_login_node(machine, "kochi interact_aux -m {} {}".format(machine, util.serialize(args)), interactive=True)
 
 @cli.command(name="interact_aux", hidden=True)
 @machine_option
@@ -297,7 +341,7 @@ def interact_aux_cmd(machine, args_serialized):
                             "exit 0".format(ip, port, token))
         activate_script = job.activate_script + ["export KOCHI_FORWARD_PORT={}".format(args.forward_target_port)]
         job_interact = job_queue.Job(job.name, job.machine, job.project_name, job.queue, job.dependencies, job.context, job.params,
-                                     job.artifacts_conf, activate_script, job.build_conf, dict(job.run_conf, script=commands))
+                                     job.artifacts_conf, activate_script, job.build_conf, dict(job.run_conf, script=commands), job.resources)
         job_enqueued = job_queue.push(job_interact)
         click.secho("Job {} submitted on machine {} (listening on {}:{}).".format(job_enqueued.id, machine, host, port), fg="blue")
     def on_accept(remote_host, remote_port):
@@ -339,6 +383,7 @@ def batch_cmd(click_ctx, machine, job_config_file, batch_name, git_remote):
     params = job_config.batch_params(job_config_file, batch_name, machine)
     params.update(batch_name=batch_name)
     artifacts_conf = job_config.batch_artifacts(job_config_file, batch_name, machine)
+    resources = job_config.batch_resources(job_config_file, batch_name, machine)
 
     deps = job_config.batch_dependencies(job_config_file, batch_name, machine)
     rec_deps = get_dependencies_recursively(deps, machine)
@@ -348,22 +393,24 @@ def batch_cmd(click_ctx, machine, job_config_file, batch_name, git_remote):
 
     if not util.is_inside_git_dir():
         raise click.UsageError("--with-context (-c) option must be used inside a git directory.")
-    if not git_remote:
-        project.sync(machine)
     ctx = context.create(git_remote)
+    if not git_remote:
+        project.sync(machine, ctx.reference)
 
+    jobs = []
     for p in util.param_product(params):
         p = util.param_substitute(p)
         for dup in range(duplicates):
             p.update(duplicate=dup)
             queue = queue_name_template.substitute(p)
             job_name = job_name_template.substitute(p)
-            job = job_queue.Job(job_name, machine, project_name, queue, rec_deps, ctx, p,
-                                artifacts_conf, activate_script, build_conf, run_conf)
-            if machine == "local":
-                click_ctx.invoke(enqueue_aux_cmd, machine=machine, job_serialized=util.serialize(job))
-            else:
-                run_on_login_node(machine, "kochi enqueue_aux -m {} {}".format(machine, util.serialize(job)))
+            jobs.append(job_queue.Job(job_name, machine, project_name, queue, rec_deps, ctx, p.copy(),
+                                      artifacts_conf, activate_script, build_conf, run_conf, parse_resources(resources, p)))
+    if machine == "local":
+        enqueue_jobs(machine, jobs)
+    else:
+        run_on_login_node(machine, "kochi enqueue_bulk_aux -m {}".format(machine),
+                          input=util.serialize(jobs))
 
 # cacnel
 # -----------------------------------------------------------------------------
@@ -409,7 +456,47 @@ def inspect_cmd(machine, on_machine, worker_id):
     if on_machine:
         sshd.login_to_machine(machine, worker_id)
     else:
-        run_on_login_node(machine, "kochi inspect -m {} --on-machine {}".format(machine, worker_id))
+        run_on_login_node(machine, "kochi inspect -m {} --on-machine {}".format(machine, worker_id), interactive=True)
+
+# agent
+# -----------------------------------------------------------------------------
+
+@cli.group(name="agent")
+def agent_group():
+    pass
+
+@agent_group.command(name="start")
+@machine_option
+def agent_start_cmd(machine):
+    """
+    Starts an agent on the login node of MACHINE, which keeps kochi loaded to run remote commands quickly.
+    The agent exits after being idle for an hour. Commands fall back to ssh when no agent is running.
+    """
+    if machine == "local":
+        raise click.UsageError("MACHINE cannot be 'local'.")
+    path = agent.start(machine)
+    click.secho("Kochi agent started on machine {} (listening on {}).".format(machine, path), fg="green")
+
+@agent_group.command(name="stop")
+@machine_option
+def agent_stop_cmd(machine):
+    """
+    Stops the agent on the login node of MACHINE.
+    """
+    agent.stop(machine)
+
+@cli.command(name="agent_aux", hidden=True)
+@machine_option
+@click.option("--daemon", is_flag=True, default=False, help="Run in background")
+@click.option("--idle-timeout", type=int, default=3600, help="Exit after being idle for IDLE_TIMEOUT seconds")
+def agent_aux_cmd(machine, daemon, idle_timeout):
+    """
+    For internal use only.
+    """
+    print(agent.socket_filepath(machine), flush=True)
+    if daemon:
+        agent.daemonize(agent.socket_filepath(machine))
+    agent.serve(machine, idle_timeout=idle_timeout)
 
 # run
 # -----------------------------------------------------------------------------
@@ -427,10 +514,11 @@ def run_cmd(machine, dependency, commands):
     deps = get_dependencies_recursively(parse_dependencies(dependency), machine)
     activate_script = sum([config.recipe_activate_script(d, r) for d, r in deps.items()], [])
     dep_envs = installer.deps_env(project_name, machine, deps)
-    scripts = activate_script + [subprocess.list2cmdline(list(commands))]
     env = os.environ.copy()
     env["KOCHI_MACHINE"] = machine
     env.update(dep_envs)
+    env, activate_script = installer.activate(project_name, machine, deps, activate_script, env)
+    scripts = activate_script + [subprocess.list2cmdline(list(commands))]
     subprocess.run("\n".join(scripts), env=env, shell=True, executable="/bin/bash")
 
 # work
@@ -440,57 +528,117 @@ def run_cmd(machine, dependency, commands):
 @machine_option
 @click.option("-q", "--queue", metavar="QUEUE", required=True, help="Queue to work on")
 @click.option("-b", "--blocking", is_flag=True, default=False, help="Whether to block to wait for job arrival")
+@click.option("-p", "--prefetch", metavar="N", type=click.IntRange(min=1), default=1, help="Number of jobs claimed from QUEUE at a time")
+@click.option("-s", "--slots", metavar="N", type=click.IntRange(min=1), default=1, help="Number of jobs run concurrently (packed by `cores` and `memory` of jobs)")
+@click.option("--pipeline", is_flag=True, default=False, help="Whether to prepare the context of the next job while running a job (with one slot)")
+@click.option("--scratch-dir", metavar="DIR", envvar="KOCHI_SCRATCH_DIR", help="Node-local directory where the workspace is placed (e.g., /tmp)")
 @click.option("-i", "--worker-id", type=int, default=-1, hidden=True, help="For internal use only")
-def work_cmd(machine, queue, blocking, worker_id):
+def work_cmd(machine, queue, blocking, prefetch, slots, pipeline, scratch_dir, worker_id):
     """
     Start a new worker that works on QUEUE.
     Assume that this command is invoked on MACHINE.
     """
     worker_id = worker.init(machine, queue, worker_id) if worker_id == -1 else worker_id
-    worker.start(queue, blocking, worker_id, machine)
+    worker.start(queue, blocking, worker_id, machine, prefetch, slots, pipeline, scratch_dir)
 
 # install
 # -----------------------------------------------------------------------------
 
+def install_one(machine, args, queue, jobs, force, export, wait):
+    """
+    Returns True if the installation succeeded (or was submitted as a job when `wait` is false).
+    """
+    install_cmd = "kochi install_aux -m {} {}{}{}".format(machine, "--force " if force else "", "--export " if export else "", util.serialize(args))
+    if machine == "local":
+        if jobs == 1:
+            return installer.install(args, machine, force, export)
+        else:
+            # installation changes the current directory, so concurrent ones are run in separate processes
+            return subprocess.run(install_cmd, shell=True, executable="/bin/bash").returncode == 0
+    elif args.on_machine:
+        job = job_queue.Job("KOCHI-INSTALL", machine, args.project, queue, args.recipe_dependencies, args.context, dict(),
+                            [], args.activate_script, dict(), dict(script=[install_cmd]))
+        return run_on_login_node(machine, "kochi enqueue_aux -m {} {} {}".format(machine, "-w" if wait else "", util.serialize(job))) == 0
+    else:
+        return run_on_login_node(machine, install_cmd) == 0
+
 @cli.command(name="install")
 @machine_option
 @dependency_option
+@click.option("-a", "--all", is_flag=True, default=False, help="Install all recipes in the config.")
+@click.option("-j", "--jobs", metavar="N", type=click.IntRange(min=1), default=1, help="Number of recipes installed concurrently")
+@click.option("-f", "--force", is_flag=True, default=False, help="Reinstall recipes even if their inputs are not changed.")
+@click.option("-e", "--export", is_flag=True, default=False, help="Export installations as bundles to 'bundle_store' of MACHINE.")
 @click.option("-q", "--queue", metavar="QUEUE", help="Queue to which installation jobs are submitted (only when on_machine = true)")
-@click.pass_context
-def install_cmd(click_ctx, machine, dependency, queue):
+def install_cmd(machine, dependency, all, jobs, force, export, queue):
     """
     Install projects that are depended on by this repository on MACHINE.
+
+    Recipes are installed in the order of their dependencies ('depends' in the config),
+    and a recipe is started as soon as the recipes it depends on are installed.
+
+    Installation is skipped if the scripts, envs, source commit/diff, and dependencies of the recipe are not changed.
+    Identical installations are shared by projects via the install cache on MACHINE.
+    If 'bundle_store' is set for MACHINE, installations exported by machines of the same 'machine_class'
+    are imported (relocated) instead of being built from source.
     """
     project_name = project.project_name_of_cwd()
-    for dep, recipe in parse_dependencies(dependency).items():
+    if all:
+        targets = project.get_all_recipes()
+    elif len(dependency) > 0:
+        targets = list(parse_dependencies(dependency).items())
+    else:
+        raise click.UsageError("Please specify dependencies with --dependency (-d) or --all (-a).")
+    install_args = dict()
+    for dep, recipe in targets:
         ctx = installer.get_install_context(machine, dep, recipe)
         recipe_deps = config.recipe_dependencies(dep, recipe, machine)
         on_machine = config.recipe_on_machine(dep, recipe)
+        if on_machine and machine != "local" and not queue:
+            raise click.UsageError("Please specify --queue (-q) option to install {}:{} (on_machine = true)".format(dep, recipe))
         rec_deps = get_dependencies_recursively(recipe_deps, machine)
         activate_script = sum([config.recipe_activate_script(d, r) for d, r in rec_deps.items()], [])
-        args = installer.InstallConf(project_name, dep, recipe, on_machine, rec_deps, ctx,
-                                     config.recipe_envs(dep, recipe), activate_script, config.recipe_script(dep, recipe))
-        if machine == "local":
-            click_ctx.invoke(install_aux_cmd, machine=machine, args_serialized=util.serialize(args))
-        else:
-            install_cmd = "kochi install_aux -m {} {}".format(machine, util.serialize(args))
-            if on_machine:
-                if not queue:
-                    raise click.UsageError("Please specify --queue (-q) option to install {}:{} (on_machine = true)".format(dep, recipe))
-                job = job_queue.Job("KOCHI-INSTALL", machine, project_name, queue, rec_deps, ctx, dict(),
-                                    [], activate_script, dict(), dict(script=[install_cmd]))
-                run_on_login_node(machine, "kochi enqueue_aux -m {} {}".format(machine, util.serialize(job)))
-            else:
-                run_on_login_node(machine, install_cmd)
+        install_args[(dep, recipe)] = installer.InstallConf(project_name, dep, recipe, on_machine, rec_deps, ctx,
+                                                            config.recipe_envs(dep, recipe), activate_script, config.recipe_script(dep, recipe),
+                                                            config.machine_class(machine), config.bundle_store(machine))
+    # recipes being installed together wait for their dependencies (not installed together ones must be installed already)
+    graph = {(d, r): [dr for dr in config.recipe_dependencies(d, r, machine).items() if dr in install_args] for d, r in install_args}
+    dependents = set(sum(graph.values(), []))
+    failed, skipped = util.run_dag(graph, lambda dr: install_one(machine, install_args[dr], queue, jobs, force, export, dr in dependents), jobs,
+                                   name=lambda dr: "Installation for {}:{}".format(*dr))
+    for d, r in skipped:
+        click.secho("Installation for {}:{} was skipped because its dependencies were not installed.".format(d, r), fg="red", file=sys.stderr)
+    if len(failed) + len(skipped) > 0:
+        exit(1)
 
 @cli.command(name="install_aux", hidden=True)
 @machine_option
+@click.option("-f", "--force", is_flag=True, default=False)
+@click.option("-e", "--export", is_flag=True, default=False)
 @click.argument("args_serialized", required=True)
-def install_aux_cmd(machine, args_serialized):
+def install_aux_cmd(machine, force, export, args_serialized):
     """
     For internal use only.
     """
-    installer.install(util.deserialize(args_serialized), machine)
+    if not installer.install(util.deserialize(args_serialized), machine, force, export):
+        exit(1)
+
+# bundle
+# -----------------------------------------------------------------------------
+
+@cli.group(name="bundle")
+def bundle_group():
+    pass
+
+@bundle_group.command(name="serve")
+@click.option("-p", "--port", metavar="PORT", type=int, default=8000, help="Port number to listen on")
+@click.option("--bind", metavar="ADDRESS", default="127.0.0.1", help="Address to listen on (anyone who can reach it can upload bundles)")
+@click.argument("store_dir", required=True)
+def bundle_serve_cmd(port, bind, store_dir):
+    """
+    Serves install bundles in STORE_DIR over HTTP, which can be set as 'bundle_store' (e.g., 'http://host:8000').
+    """
+    bundle.serve(store_dir, port, bind)
 
 # artifact
 # -----------------------------------------------------------------------------
@@ -509,11 +657,26 @@ def artifact_init_cmd(git_worktree_path):
 
 @artifact_group.command(name="sync")
 @machine_option
-def artifact_sync_cmd(machine):
+@click.option("-j", "--jobs", metavar="N", type=click.IntRange(min=1), default=8, help="Number of large artifacts fetched in parallel")
+def artifact_sync_cmd(machine, jobs):
     """
     Gets (pulls) job artifacts from MACHINE and saves them in the artifact worktree.
     """
-    artifact.sync(machine)
+    artifact.sync(machine, jobs)
+
+@on_machine_cmd(artifact_group, "status")
+def artifact_status_cmd(machine):
+    """
+    Shows job artifacts on MACHINE that are not published to the artifact branch yet.
+    """
+    stats.show_pending_artifacts(machine)
+
+@on_machine_cmd(artifact_group, "publish")
+def artifact_publish_cmd(machine):
+    """
+    Publishes pending job artifacts on MACHINE now (waits for the running publisher if any).
+    """
+    artifact.publish(machine, blocking=True)
 
 @artifact_group.command(name="discard")
 @machine_option
@@ -623,12 +786,18 @@ def path():
 @on_machine_cmd(path, "project")
 @click.option("-f", "--force", is_flag=True, default=False, help="Force to show the project path even if the project does not exist")
 @click.option("--is-artifact", is_flag=True, default=False, help="Get an artifact git path")
+@click.option("--is-blob", is_flag=True, default=False, help="Get a path to the blob store (including large artifacts)")
 @click.argument("project_name", required=True, type=str)
-def show_path_project_cmd(machine, force, project_name, is_artifact):
+def show_path_project_cmd(machine, force, project_name, is_artifact, is_blob):
     """
     Show a path to PROJECT_NAME on MACHINE.
     """
-    project_path = settings.project_artifact_git_dirpath(project_name) if is_artifact else settings.project_git_dirpath(project_name)
+    if is_blob:
+        project_path = settings.project_blob_dirpath(project_name)
+    elif is_artifact:
+        project_path = settings.project_artifact_git_dirpath(project_name)
+    else:
+        project_path = settings.project_git_dirpath(project_name)
     if force or os.path.isdir(project_path):
         print(project_path)
     else:
@@ -1,6 +1,5 @@
 import sys
 import collections
-import yaml
 
 from . import settings
 
@@ -8,6 +7,7 @@ loaded_config = None
 
 def root_config():
     global loaded_config
+    import yaml
     if not loaded_config:
         try:
             with open(settings.config_filepath(), "r") as f:
@@ -57,6 +57,10 @@ def alloc_interact_script(m):
 
 def _load_env_script(m, key):
     s = ["export KOCHI_ROOT={}".format(root_dir(m))] if root_dir(m) else []
+    if scratch_dir(m):
+        s.append("export KOCHI_SCRATCH_DIR=\"{}\"".format(scratch_dir(m)))
+    if not activate_cache(m):
+        s.append("export KOCHI_ACTIVATE_CACHE=0")
     ls = dict_get(machine(m), "load_env_script", default=None)
     if isinstance(ls, list) or isinstance(ls, str):
         return s + wrap_list(ls)
@@ -77,6 +81,22 @@ def work_dir(m):
 def root_dir(m):
     return dict_get(machine(m), "kochi_root", default=None)
 
+def activate_cache(m):
+    # whether the environment activated by `activate_script` of recipes is cached instead of running it for every job
+    return dict_get(machine(m), "activate_cache", default=True)
+
+def machine_class(m):
+    # machines of the same class (e.g., the same ISA and OS image) can share install bundles
+    return dict_get(machine(m), "machine_class", default=m)
+
+def bundle_store(m):
+    # directory or URL (http/https) where install bundles are exchanged
+    return dict_get(machine(m), "bundle_store", default=None)
+
+def scratch_dir(m):
+    # node-local directory for worker workspaces (environment variables are expanded on compute nodes)
+    return dict_get(machine(m), "scratch_dir", default=None)
+
 # Dependencies
 # -----------------------------------------------------------------------------
 
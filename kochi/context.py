@@ -1,6 +1,8 @@
 from collections import namedtuple
 import os
+import re
 import sys
+import hashlib
 import subprocess
 import contextlib
 
@@ -8,8 +10,11 @@ from . import util
 from . import settings
 from . import config
 from . import project
+from . import blob
 
-Context = namedtuple("Context", ["project", "git_remote", "reference", "diff"])
+# `diff` holds the diff itself until the context is stored on the machine, after which only `diff_hash` is kept
+Context = namedtuple("Context", ["project", "git_remote", "reference", "diff", "diff_hash"])
+Context.__new__.__defaults__ = (None,)
 
 def create(git_remote):
     project_name = project.project_name_of_cwd()
@@ -46,20 +51,119 @@ def create_for_recipe(dep, recipe, git_remote):
         print("Please specify any of 'mirror', 'branch', and 'commit_hash' option in recipe config.", file=sys.stderr)
         exit(1)
 
+def store(ctx):
+    """
+    Moves the diff of the context to the blob store so that only its hash is carried around.
+    Must be called on the machine.
+    """
+    if ctx and ctx.diff:
+        return ctx._replace(diff=None, diff_hash=blob.put(ctx.project, ctx.diff))
+    else:
+        return ctx
+
+def load_diff(ctx):
+    if not ctx:
+        return None
+    elif ctx.diff_hash:
+        return blob.get(ctx.project, ctx.diff_hash)
+    else:
+        return ctx.diff
+
+def diff_hash(ctx):
+    if ctx.diff_hash:
+        return ctx.diff_hash
+    elif ctx.diff:
+        return blob.compute_hash(ctx.diff)
+    else:
+        return None
+
+def is_commit_hash(reference):
+    return re.fullmatch(r"[0-9a-f]{40}", reference) is not None
+
+def resolve_commit(reference):
+    ret = subprocess.run(["git", "rev-parse", "--verify", "-q", reference + "^{commit}"], stdout=subprocess.PIPE, encoding="utf-8")
+    return ret.stdout.strip() if ret.returncode == 0 else None
+
+def worktree_state():
+    """
+    Returns a hash of the changes in the worktree from HEAD, including untracked files and the commits of submodules.
+    """
+    status = subprocess.run(["git", "status", "--porcelain", "-z", "--untracked-files=all"], stdout=subprocess.PIPE, check=True).stdout
+    h = hashlib.sha256(status)
+    h.update(subprocess.run(["git", "diff", "--binary", "HEAD"], stdout=subprocess.PIPE, check=True).stdout)
+    for entry in status.split(b"\0"):
+        if entry.startswith(b"?? "):
+            path = entry[3:]
+            if os.path.islink(path):
+                h.update(os.readlink(path))
+            elif os.path.isfile(path):
+                with open(path, "rb") as f:
+                    h.update(f.read())
+    return h.hexdigest()
+
+# The fingerprint of the last deployed context is saved in the git dir of the checkout with the worktree state right after deployment.
+# If the state differs when the next job comes (e.g., the previous job modified tracked files), the fingerprint is ignored.
+def deployed_filepath():
+    git_path = subprocess.run(["git", "rev-parse", "--git-path", "kochi_deployed"], stdout=subprocess.PIPE, encoding="utf-8", check=True).stdout.strip()
+    return os.path.abspath(git_path)
+
+def load_deployed():
+    try:
+        with open(deployed_filepath(), "r") as f:
+            return util.deserialize(f.read())
+    except (FileNotFoundError, EOFError, ValueError):
+        return None
+
+def save_deployed(fingerprint):
+    with open(deployed_filepath(), "w") as f:
+        f.write(util.serialize((fingerprint, worktree_state())))
+
+def invalidate_deployed():
+    try:
+        os.remove(deployed_filepath())
+    except FileNotFoundError:
+        pass
+
 def deploy(ctx):
-    subprocess.run(["git", "fetch", "-q"], check=True)
+    # A branch name may point to a new commit on the remote, whereas a commit hash needs to be fetched only if missing
+    commit_hash = resolve_commit(ctx.reference) if is_commit_hash(ctx.reference) else None
+    if not commit_hash:
+        subprocess.run(["git", "fetch", "-q"], check=True)
+        commit_hash = resolve_commit(ctx.reference)
+    if not commit_hash and is_commit_hash(ctx.reference):
+        # pushed as a hidden ref by `project.sync`, which is not fetched by default
+        subprocess.run(["git", "fetch", "-q", "origin", ctx.reference], check=True)
+        commit_hash = resolve_commit(ctx.reference)
+    fingerprint = (commit_hash, diff_hash(ctx))
+    deployed = load_deployed()
+    if commit_hash and deployed and deployed == (fingerprint, worktree_state()):
+        return
+    invalidate_deployed()
     subprocess.run(["git", "checkout", "-f", "-q", ctx.reference], check=True)
     subprocess.run(["git", "submodule", "update", "--init", "--recursive", "--quiet"], check=True)
     subprocess.run(["git", "clean", "-f", "-d", "-q"], check=True)
-    if ctx.diff:
-        subprocess.run(["git", "apply", "--whitespace=nowarn", "-"], input=ctx.diff, encoding="utf-8", check=True)
+    diff = load_diff(ctx)
+    if diff:
+        subprocess.run(["git", "apply", "--whitespace=nowarn", "-"], input=diff, encoding="utf-8", check=True)
+    if commit_hash:
+        save_deployed(fingerprint)
+
+def clone(ctx):
+    """
+    Clones the project into the current directory without copying git objects that are already on the machine;
+    they are borrowed from the bare repository of the project via git alternates.
+    """
+    git_dirpath = settings.project_git_dirpath(ctx.project)
+    if ctx.git_remote:
+        subprocess.run(["git", "clone", "-q", "--reference-if-able", git_dirpath, ctx.git_remote, ctx.project], check=True)
+    else:
+        subprocess.run(["git", "clone", "-q", "--shared", git_dirpath, ctx.project], check=True)
 
 @contextlib.contextmanager
 def context(ctx):
     if ctx:
         if not os.path.isdir(ctx.project):
-            git_remote = ctx.git_remote if ctx.git_remote else settings.project_git_dirpath(ctx.project)
-            subprocess.run(["git", "clone", "-q", git_remote, ctx.project], check=True)
+            clone(ctx)
         with util.cwd(ctx.project):
             deploy(ctx)
             yield
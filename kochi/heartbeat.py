@@ -1,12 +1,12 @@
 from collections import namedtuple
-import sys
+import os
 import time
-import queue
-import multiprocessing
-import contextlib
+import math
 import enum
+import struct
 
 from . import util
+from . import settings
 
 class RunningState(enum.IntEnum):
     def __str__(self):
@@ -23,8 +23,17 @@ class RunningState(enum.IntEnum):
     RUNNING = 2
     TERMINATED = 3
 
-state_fields = ["running_state", "init_time", "start_time", "latest_time"]
+state_fields = ["running_state", "init_time", "start_time", "latest_time", "queue", "job_id", "deadline"]
 State = namedtuple("State", state_fields)
+# for states pickled by old versions
+State.__new__.__defaults__ = (None, None, None)
+
+# Heartbeats of all workers on a machine are stored in a single table file with a fixed-size slot per worker ID.
+# Each worker updates only its own slot, and readers can get the states of all workers with one sequential read.
+#
+# Slot format: running_state, init_time, start_time, latest_time, job_id, deadline (0 or -1 for None), queue
+# A worker is regarded as dead if the deadline has passed without updating the slot.
+slot_struct = struct.Struct("<qqqqqq64s")
 
 def update_state(state, **kwargs):
     d = dict()
@@ -35,58 +44,90 @@ def update_state(state, **kwargs):
 def current_timestamp():
     return int(time.time())
 
-def update_timestamp(filename, **opts):
-    timestamp = current_timestamp()
-    with open(filename, "r+") as f:
-        state = util.deserialize(f.read())
-        start_time = timestamp if state.running_state == RunningState.WAITING else state.start_time
-        next_state = update_state(state, running_state=opts.get("state", RunningState.RUNNING), start_time=start_time, latest_time=current_timestamp())
-        f.seek(0)
-        f.write(util.serialize(next_state))
-        f.truncate()
-
-def daemon(q, filename, interval):
-    while True:
-        try:
-            update_timestamp(filename)
-            try:
-                item = q.get(timeout=interval)
-            except queue.Empty:
-                pass
-            else:
-                if item == "terminate":
-                    update_timestamp(filename, state=RunningState.TERMINATED)
-                    return
-                else:
-                    print("Something is wrong in heartbeat.", file=sys.stderr)
-                    exit(1)
-        except KeyboardInterrupt:
-            pass
-
-@contextlib.contextmanager
-def heartbeat(filepath, **opts):
-    q = multiprocessing.Queue()
-    p = multiprocessing.Process(target=daemon, args=(q, filepath, opts.get("interval", 3)))
-    p.start()
+def invalid_state():
+    return State(RunningState.INVALID, None, None, None, None, None, None)
+
+def encode_slot(state):
+    queue = (state.queue or "").encode()
+    return slot_struct.pack(state.running_state, state.init_time or 0, state.start_time or 0, state.latest_time or 0,
+                            -1 if state.job_id is None else state.job_id, state.deadline or 0,
+                            queue if len(queue) <= 64 else b"")
+
+def decode_slot(data):
+    running_state, init_time, start_time, latest_time, job_id, deadline, queue = slot_struct.unpack(data)
+    return State(RunningState(running_state), init_time or None, start_time or None, latest_time or None,
+                 queue.rstrip(b"\x00").decode() or None, None if job_id < 0 else job_id, deadline or None)
+
+def write_slot(machine, worker_id, state):
+    fd = os.open(settings.worker_heartbeat_table_filepath(machine), os.O_RDWR | os.O_CREAT, 0o644)
     try:
-        yield
+        os.pwrite(fd, encode_slot(state), worker_id * slot_struct.size)
     finally:
-        q.put("terminate")
-        p.join()
+        os.close(fd)
 
-def get_state(filepath, **opts):
+def read_slot(machine, worker_id):
     try:
-        with open(filepath, "r") as f:
-            state = util.deserialize(f.read())
-        if state.running_state == RunningState.RUNNING:
-            running_state = RunningState.TERMINATED if state.latest_time + opts.get("margin", 10) < current_timestamp() else RunningState.RUNNING
-            return update_state(state, running_state=running_state)
+        with open(settings.worker_heartbeat_table_filepath(machine), "rb") as f:
+            f.seek(worker_id * slot_struct.size)
+            data = f.read(slot_struct.size)
+    except FileNotFoundError:
+        return invalid_state()
+    return decode_slot(data) if len(data) == slot_struct.size else invalid_state()
+
+def read_table(machine):
+    try:
+        with open(settings.worker_heartbeat_table_filepath(machine), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    return [decode_slot(data[i:i + slot_struct.size]) for i in range(0, len(data) - slot_struct.size + 1, slot_struct.size)]
+
+def update_timestamp(machine, worker_id, interval, **opts):
+    """
+    Updates the slot of the worker. The worker must update it again within `interval` seconds (+ margin).
+    """
+    timestamp = current_timestamp()
+    state = read_slot(machine, worker_id)
+    start_time = timestamp if state.running_state == RunningState.WAITING else state.start_time
+    next_state = update_state(state, running_state=opts.get("state", RunningState.RUNNING), start_time=start_time,
+                              latest_time=timestamp, job_id=opts.get("job_id"),
+                              deadline=timestamp + int(math.ceil(interval)) + opts.get("margin", 10))
+    write_slot(machine, worker_id, next_state)
+
+def resolve_state(state):
+    if state.running_state == RunningState.RUNNING:
+        if state.deadline < current_timestamp():
+            return update_state(state, running_state=RunningState.TERMINATED)
         else:
-            return state
+            return update_state(state, latest_time=current_timestamp())
+    else:
+        return state
+
+def get_legacy_state(machine, worker_id, **opts):
+    """
+    Reads a heartbeat file written by old versions of workers.
+    """
+    try:
+        with open(settings.worker_heartbeat_filepath(machine, worker_id), "r") as f:
+            state = util.deserialize(f.read())
+        deadline = state.latest_time + opts.get("margin", 10) if state.latest_time else None
+        return resolve_state(update_state(state, deadline=deadline))
     except:
-        return State(RunningState.INVALID, None, None, None)
+        return invalid_state()
+
+def get_state(machine, worker_id):
+    state = read_slot(machine, worker_id)
+    if state.running_state == RunningState.INVALID:
+        return get_legacy_state(machine, worker_id)
+    else:
+        return resolve_state(state)
+
+def get_all_states(machine):
+    """
+    Returns a dict of worker ID -> state for all workers that have a slot in the table.
+    """
+    return {idx: resolve_state(state) for idx, state in enumerate(read_table(machine))
+            if state.running_state != RunningState.INVALID}
 
-def init(filepath):
-    with open(filepath, "w") as f:
-        state = State(RunningState.WAITING, current_timestamp(), None, None)
-        f.write(util.serialize(state))
+def init(machine, worker_id, queue):
+    write_slot(machine, worker_id, State(RunningState.WAITING, current_timestamp(), None, None, queue, None, None))
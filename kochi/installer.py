@@ -1,12 +1,14 @@
 from collections import namedtuple
 import os
+import re
 import sys
 import shutil
 import subprocess
 import time
 import datetime
+import glob
+import hashlib
 import click
-import tabulate
 
 from . import util
 from . import settings
@@ -14,9 +16,15 @@ from . import config
 from . import project
 from . import context
 
-InstallConf = namedtuple("InstallConf", ["project", "dependency", "recipe", "on_machine", "recipe_dependencies", "context", "envs", "activate_script", "script"])
-state_fields = ["project", "dependency", "recipe", "on_machine", "recipe_dependency_states", "context", "envs", "activate_script", "script", "installed_time", "commit_hash"]
+# only needed for install bundles
+bundle = util.lazy_import(__package__ + ".bundle")
+tabulate = util.lazy_import("tabulate")
+
+InstallConf = namedtuple("InstallConf", ["project", "dependency", "recipe", "on_machine", "recipe_dependencies", "context", "envs", "activate_script", "script", "machine_class", "bundle_store"])
+InstallConf.__new__.__defaults__ = (None, None)
+state_fields = ["project", "dependency", "recipe", "on_machine", "recipe_dependency_states", "context", "envs", "activate_script", "script", "installed_time", "commit_hash", "fingerprint", "dependency_requirements"]
 State = namedtuple("State", state_fields)
+State.__new__.__defaults__ = (None, None)
 
 def get_install_context(machine, dep, recipe):
     git_path = config.recipe_git(dep, recipe)
@@ -31,18 +39,26 @@ def get_install_context(machine, dep, recipe):
     else:
         return None
 
-def on_complete(conf, machine, env):
+def on_complete(conf, machine, env, fingerprint):
     recipe_dependency_states = [get_state(conf.project, d, r, machine) for d, r in conf.recipe_dependencies.items()]
     commit_hash = subprocess.run(["git", "rev-parse", conf.context.reference], stdout=subprocess.PIPE, encoding="utf-8", check=True).stdout.strip() if conf.context else None
-    with open(settings.project_dep_install_state_filepath(conf.project, machine, conf.dependency, conf.recipe), "w") as f:
-        state = State(conf.project, conf.dependency, conf.recipe, conf.on_machine, recipe_dependency_states,
-                      conf.context, env, conf.activate_script, conf.script, time.time(), commit_hash)
+    state = State(conf.project, conf.dependency, conf.recipe, conf.on_machine, recipe_dependency_states,
+                  context.store(conf.context), env, conf.activate_script, conf.script, time.time(), commit_hash, fingerprint)
+    state = state._replace(dependency_requirements=dependency_requirements(state))
+    save_state(settings.project_dep_install_state_filepath(conf.project, machine, conf.dependency, conf.recipe), state)
+
+def save_state(filepath, state):
+    # replaced atomically so that cached states are invalidated by the inode
+    tmp_filepath = "{}.tmp.{}.{}".format(filepath, os.uname()[1], os.getpid())
+    with open(tmp_filepath, "w") as f:
         f.write(util.serialize(state))
+    os.replace(tmp_filepath, filepath)
 
 def dep_env(project_name, machine, dep, recipe):
     dep_upper_name = dep.upper().replace("-", "_")
     env = dict()
-    env["KOCHI_INSTALL_PREFIX_" + dep_upper_name] = settings.project_dep_install_dest_dirpath(project_name, machine, dep, recipe)
+    # resolved to the shared prefix in the install cache, so that it is embedded in dependents regardless of the project
+    env["KOCHI_INSTALL_PREFIX_" + dep_upper_name] = os.path.realpath(settings.project_dep_install_dest_dirpath(project_name, machine, dep, recipe))
     env["KOCHI_RECIPE_" + dep_upper_name] = recipe
     return env
 
@@ -53,16 +69,32 @@ def deps_env(project_name, machine, deps):
         dep_envs.update(dep_env(project_name, machine, d, r))
     return dep_envs
 
-def check_dependencies_aux(project_name, machine, current_dep_states, installed_dep_state):
-    for ds in installed_dep_state.recipe_dependency_states:
-        current_state = current_dep_states[ds.dependency]
-        if current_state.installed_time != ds.installed_time:
+def dependency_requirements(state):
+    """
+    Returns the versions of all recipes (recursively) that `state` was installed with, as a list of
+    (dependency, recipe, installed time, dependent dependency, dependent recipe).
+    This is precomputed when installed, so that dependencies can be checked without walking the nested states.
+    """
+    if state.dependency_requirements is not None:
+        return state.dependency_requirements
+    reqs = []
+    for ds in state.recipe_dependency_states:
+        reqs.append((ds.dependency, ds.recipe, ds.installed_time, state.dependency, state.recipe))
+        reqs.extend(dependency_requirements(ds))
+    return list(dict.fromkeys(reqs))
+
+def check_dependency_requirements(current_dep_states, installed_dep_state):
+    for dep, recipe, installed_time, dependent, dependent_recipe in dependency_requirements(installed_dep_state):
+        current_state = current_dep_states[dep]
+        if current_state.installed_time != installed_time:
             raise Exception(util.dedent("""
                 Installation version mismatch for {0}:{1}.
                 The current version of recipe {0}:{1} was installed at {2}, but {3}:{4} was installed using a version installed at {5}.
-                """.format(ds.dependency, ds.recipe, datetime.datetime.fromtimestamp(current_state.installed_time),
-                           installed_dep_state.dependency, installed_dep_state.recipe, datetime.datetime.fromtimestamp(ds.installed_time))))
-        check_dependencies_aux(project_name, machine, current_dep_states, ds)
+                """.format(dep, recipe, datetime.datetime.fromtimestamp(current_state.installed_time),
+                           dependent, dependent_recipe, datetime.datetime.fromtimestamp(installed_time))))
+
+# Sets of installations (dependency, recipe, installed time) already checked in this process
+checked_dependencies = set()
 
 def check_dependencies(project_name, machine, deps):
     """
@@ -74,18 +106,287 @@ def check_dependencies(project_name, machine, deps):
     - Such inconsistency is checked here by comparing B's current state and that recoreded in A's state
     """
     current_dep_states = {d: get_state(project_name, d, r, machine) for d, r in deps.items()}
+    key = frozenset((d, ds.recipe, ds.installed_time) for d, ds in current_dep_states.items())
+    if key in checked_dependencies:
+        return
     for d, ds in current_dep_states.items():
         print("Checking dependencies for {}:{}...".format(d, ds.recipe), flush=True)
-        check_dependencies_aux(project_name, machine, current_dep_states, ds)
+        check_dependency_requirements(current_dep_states, ds)
+    checked_dependencies.add(key)
+
+# Activated environments
+# -----------------------------------------------------------------------------
+#
+# The environment variables set by the activate scripts of dependencies (e.g., `module load`) are captured once for
+# each set of installations and saved in the install dir of the project, so that jobs apply them instead of running
+# the scripts. The cache is keyed by the scripts, the installation states and the values of variables referenced in the
+# scripts (e.g., $KOCHI_PARAM_*), so it is invalidated when they change.
+# Set `activate_cache: false` for the machine if the scripts have other effects (e.g., non-exported variables).
+
+activated_env_ignored_vars = ["_", "SHLVL", "PWD", "OLDPWD"]
+
+# Activated environments loaded in this process
+activated_env_cache = dict()
+
+def referenced_vars(activate_script, env):
+    names = set(re.findall(r"\$\{?([A-Za-z_][A-Za-z0-9_]*)", "\n".join(activate_script)))
+    return sorted((k, env.get(k)) for k in names)
+
+def activated_env_key(project_name, machine, deps, activate_script, env):
+    states = [get_state(project_name, d, r, machine) for d, r in deps.items()]
+    key = (machine, activate_script, [(s.dependency, s.recipe, s.installed_time, s.fingerprint) for s in states],
+           referenced_vars(activate_script, env))
+    return hashlib.sha256(repr(key).encode()).hexdigest()
+
+def path_list_wrap(orig, v):
+    """
+    Returns (prefix, suffix) if `v` is `orig` with colon-separated entries added before and/or after it, or None otherwise.
+    """
+    i = v.find(orig)
+    while i >= 0:
+        prefix, suffix = v[:i], v[i + len(orig):]
+        if (prefix == "" or prefix.endswith(":")) and (suffix == "" or suffix.startswith(":")):
+            return (prefix, suffix)
+        i = v.find(orig, i + 1)
+    return None
+
+def capture_activated_env(activate_script, env, stdout):
+    """
+    Runs `activate_script` and returns the changes of environment variables, or None if it cannot be captured.
+    A path-list variable extended by the script (e.g., PATH) is recorded as the prefix and suffix added to the original value.
+    """
+    marker = b"\0KOCHI_ACTIVATED_ENV\0"
+    p = subprocess.run("\n".join(activate_script + ["printf '\\0KOCHI_ACTIVATED_ENV\\0'", "env -0"]), env=env, shell=True, executable="/bin/bash",
+                       stdout=subprocess.PIPE, stderr=stdout)
+    output, sep, env_output = p.stdout.rpartition(marker)
+    print(output.decode(errors="replace"), end="", file=stdout, flush=True)
+    if not sep or p.returncode != 0:
+        return None
+    activated_env = dict(e.split("=", 1) for e in env_output.decode(errors="surrogateescape").split("\0") if "=" in e)
+    diff = dict(set=dict(), wrap=dict(), unset=[])
+    for k, v in activated_env.items():
+        if k in activated_env_ignored_vars or env.get(k) == v:
+            continue
+        elif env.get(k) and path_list_wrap(env[k], v):
+            diff["wrap"][k] = path_list_wrap(env[k], v)
+        else:
+            diff["set"][k] = v
+    diff["unset"] = [k for k in env if k not in activated_env and k not in activated_env_ignored_vars]
+    return diff
+
+def apply_activated_env(diff, env):
+    env = env.copy()
+    for k in diff["unset"]:
+        env.pop(k, None)
+    env.update(diff["set"])
+    for k, (prefix, suffix) in diff["wrap"].items():
+        env[k] = prefix + env.get(k, "") + suffix
+    return env
+
+def activate(project_name, machine, deps, activate_script, env, stdout=sys.stdout):
+    """
+    Returns the environment and the activate script that still needs to be run with it.
+    If the activated environment is cached (or is captured now), no script needs to be run.
+    """
+    if len(activate_script) == 0 or os.environ.get("KOCHI_ACTIVATE_CACHE", "1") == "0":
+        return env, activate_script
+    key = activated_env_key(project_name, machine, deps, activate_script, env)
+    if key not in activated_env_cache:
+        filepath = settings.project_activate_env_filepath(project_name, machine, key)
+        try:
+            with open(filepath, "r") as f:
+                diff = util.deserialize(f.read())
+        except FileNotFoundError:
+            diff = capture_activated_env(activate_script, env, stdout)
+            if diff is None:
+                return env, activate_script
+            util.ensure_dir_exists(filepath)
+            tmp_filepath = "{}.tmp.{}.{}".format(filepath, os.uname()[1], os.getpid())
+            with open(tmp_filepath, "w") as f:
+                f.write(util.serialize(diff))
+            os.replace(tmp_filepath, filepath)
+        activated_env_cache[key] = diff
+    return apply_activated_env(activated_env_cache[key], env), []
 
-def install(conf, machine):
+# Install cache
+# -----------------------------------------------------------------------------
+#
+# Each installation is keyed by a fingerprint of its inputs (scripts, envs, the commit and diff of the source, and the
+# fingerprints of the dependencies). The install prefix is placed in the install cache shared by all projects on the
+# machine, and the install dir of the project is a symlink to it. If the fingerprint is not changed, the installation
+# is skipped, or is restored from the cache when installed by another project.
+
+def resolve_commit_hash(ctx):
+    """
+    Returns the commit hash that the context of a recipe refers to without checking it out (None if unknown).
+    """
+    if not ctx:
+        return None
+    elif context.is_commit_hash(ctx.reference):
+        return ctx.reference
+    elif ctx.git_remote:
+        ret = subprocess.run(["git", "ls-remote", ctx.git_remote, ctx.reference], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding="utf-8")
+        refs = ret.stdout.split()
+        return refs[0] if ret.returncode == 0 and len(refs) > 0 else None
+    else:
+        ret = subprocess.run(["git", "--git-dir", settings.project_git_dirpath(ctx.project), "rev-parse", "--verify", "-q", ctx.reference + "^{commit}"],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding="utf-8")
+        return ret.stdout.strip() if ret.returncode == 0 else None
+
+def compute_fingerprint(conf, machine):
+    """
+    Returns None if the fingerprint cannot be determined (the installation is not cached then).
+    """
+    commit_hash = resolve_commit_hash(conf.context)
+    if conf.context and not commit_hash:
+        return None
+    dep_fingerprints = []
+    for d, r in conf.recipe_dependencies.items():
+        fingerprint = get_state(conf.project, d, r, machine).fingerprint
+        if not fingerprint:
+            # installed by an older version of kochi
+            return None
+        dep_fingerprints.append((d, r, fingerprint))
+    key = (conf.on_machine, conf.script, sorted(conf.envs.items()), conf.activate_script,
+           commit_hash, context.diff_hash(conf.context) if conf.context else None, dep_fingerprints)
+    return hashlib.sha256(repr(key).encode()).hexdigest()
+
+def is_consistent(conf, machine, state):
+    # dependencies may have been reinstalled with the same fingerprint (e.g., by --force)
+    current_dep_states = {d: get_state(conf.project, d, r, machine) for d, r in conf.recipe_dependencies.items()}
+    try:
+        check_dependency_requirements(current_dep_states, state)
+        return True
+    except:
+        return False
+
+def is_up_to_date(conf, machine, fingerprint):
+    try:
+        state = get_state(conf.project, conf.dependency, conf.recipe, machine)
+    except:
+        return False
+    return state.fingerprint == fingerprint and is_consistent(conf, machine, state)
+
+def is_cached(conf, machine, fingerprint):
+    try:
+        with open(settings.install_cache_state_filepath(machine, fingerprint), "r") as f:
+            state = util.deserialize(f.read())
+    except:
+        return False
+    return is_consistent(conf, machine, state)
+
+def other_links(machine, cache_dir, dest_dir):
+    """
+    Returns the install dirs of other projects (or recipes) that are linked to the install cache entry `cache_dir`.
+    """
+    pattern = os.path.join(settings.project_dirpath(), "*", "install", machine, "*", "*")
+    return [d for d in glob.glob(pattern) if os.path.islink(d) and d != dest_dir and os.path.realpath(d) == os.path.realpath(cache_dir)]
+
+def link_install(dest_dir, target_dir):
+    if os.path.islink(dest_dir):
+        os.remove(dest_dir)
+    else:
+        shutil.rmtree(dest_dir, ignore_errors=True)
+    util.ensure_dir_exists(dest_dir)
+    os.symlink(target_dir, dest_dir)
+
+# Install bundles
+# -----------------------------------------------------------------------------
+
+def dep_prefixes(dep_envs):
+    return {k: v for k, v in dep_envs.items() if k.startswith("KOCHI_INSTALL_PREFIX_")}
+
+def export_bundle(conf, machine, fingerprint, prefix_dir, dep_envs):
+    with open(settings.install_cache_state_filepath(machine, fingerprint), "r") as f:
+        state = util.deserialize(f.read())
+    # other environment variables (possibly secrets) are not exported
+    state = state._replace(envs={k: v for k, v in state.envs.items() if k in conf.envs or k.startswith("KOCHI_")})
+    if bundle.export(conf.bundle_store, conf.machine_class, fingerprint, prefix_dir, dep_prefixes(dep_envs),
+                     excludes=[".kochi_log.txt", ".kochi_state.txt"], state=util.serialize(state)):
+        print(click.style("Kochi installation for {}:{} was exported to {}.".format(conf.dependency, conf.recipe, conf.bundle_store), fg="magenta"), flush=True)
+
+def import_bundle(conf, machine, fingerprint, prefix_dir, dep_envs):
+    """
+    Returns True if the installation was imported from the bundle store.
+    """
+    try:
+        metadata = bundle.import_(conf.bundle_store, conf.machine_class, fingerprint, prefix_dir, dep_prefixes(dep_envs))
+        if not metadata:
+            return False
+        state = util.deserialize(metadata["state"])
+        # The dependencies may have been installed at different times on this machine, but the fingerprint
+        # (which includes the fingerprints of the dependencies) tells whether they were built from the same inputs
+        current_dep_states = [get_state(conf.project, d, r, machine) for d, r in conf.recipe_dependencies.items()]
+        if state.fingerprint != fingerprint or \
+           {(ds.dependency, ds.recipe, ds.fingerprint) for ds in state.recipe_dependency_states} != \
+           {(ds.dependency, ds.recipe, ds.fingerprint) for ds in current_dep_states}:
+            raise Exception("dependencies were installed differently on this machine.")
+        replacements = bundle.prefix_replacements(metadata, prefix_dir, dep_prefixes(dep_envs))
+        envs = {k: bundle.relocate_str(v, replacements) if isinstance(v, str) else v for k, v in state.envs.items()}
+        # record the local dependency states so that the import is consistent with them
+        state = state._replace(project=conf.project, context=context.store(conf.context), envs=envs,
+                               recipe_dependency_states=current_dep_states, dependency_requirements=None)
+        save_state(settings.install_cache_state_filepath(machine, fingerprint),
+                   state._replace(dependency_requirements=dependency_requirements(state)))
+        print(click.style("Kochi installation for {}:{} was imported from {}.".format(conf.dependency, conf.recipe, conf.bundle_store), fg="magenta"), flush=True)
+        return True
+    except Exception as e:
+        print(click.style("Import of the bundle for {}:{} failed (installing from source): {}".format(conf.dependency, conf.recipe, str(e)), fg="yellow"), flush=True)
+        shutil.rmtree(prefix_dir, ignore_errors=True)
+        return False
+
+def install(conf, machine, force=False, export=False):
+    """
+    Returns True if the installation succeeded (or is up to date).
+    If `force` is true, the installation is executed even if its inputs are not changed
+    (refused while the installation is shared with other projects through the install cache).
+    If `export` is true, the installation is exported to the bundle store of the machine.
+    Unless `force` is true, installations are imported from the bundle store if available.
+    """
+    color = "magenta"
     dep_envs = deps_env(conf.project, machine, conf.recipe_dependencies)
-    src_dir = settings.project_dep_install_src_dirpath(conf.project, machine, conf.dependency, conf.recipe)
     dest_dir = settings.project_dep_install_dest_dirpath(conf.project, machine, conf.dependency, conf.recipe)
+    fingerprint = compute_fingerprint(conf, machine)
+    if not fingerprint:
+        if os.path.islink(dest_dir):
+            os.remove(dest_dir)
+        shutil.rmtree(dest_dir, ignore_errors=True)
+        return execute(conf, machine, dep_envs, dest_dir, None)
+    cache_dir = settings.install_cache_entry_dirpath(machine, fingerprint)
+    if not force and is_up_to_date(conf, machine, fingerprint):
+        print(click.style("Kochi installation for {}:{} is up to date.".format(conf.dependency, conf.recipe), fg=color), flush=True)
+    else:
+        util.ensure_dir_exists(settings.install_cache_lock_filepath(machine, fingerprint))
+        # the same installation may be executed by another project at the same time
+        with util.flock(settings.install_cache_lock_filepath(machine, fingerprint)):
+            if force or not is_cached(conf, machine, fingerprint):
+                links = other_links(machine, cache_dir, dest_dir) if force and os.path.isdir(cache_dir) else []
+                if len(links) > 0:
+                    # the installation in use by others must not be removed while it is rebuilt
+                    print(click.style("Kochi installation for {}:{} cannot be forced because it is shared with: {}".format(
+                                      conf.dependency, conf.recipe, ", ".join(links)), fg="red"), flush=True)
+                    return False
+                shutil.rmtree(cache_dir, ignore_errors=True)
+                link_install(dest_dir, cache_dir)
+                imported = not force and conf.bundle_store and import_bundle(conf, machine, fingerprint, cache_dir, dep_envs)
+                if not imported and not execute(conf, machine, dep_envs, cache_dir, fingerprint):
+                    return False
+            else:
+                link_install(dest_dir, cache_dir)
+                print(click.style("Kochi installation for {}:{} was restored from the install cache.".format(conf.dependency, conf.recipe), fg=color), flush=True)
+    if export:
+        if not conf.bundle_store:
+            print(click.style("'bundle_store' is not set for machine {}; the installation was not exported.".format(machine), fg="yellow"), flush=True)
+        else:
+            export_bundle(conf, machine, fingerprint, cache_dir, dep_envs)
+    return True
+
+def execute(conf, machine, dep_envs, prefix_dir, fingerprint):
+    success = False
+    src_dir = settings.project_dep_install_src_dirpath(conf.project, machine, conf.dependency, conf.recipe)
     shutil.rmtree(src_dir, ignore_errors=True)
-    shutil.rmtree(dest_dir, ignore_errors=True)
     os.makedirs(src_dir, exist_ok=True)
-    os.makedirs(dest_dir, exist_ok=True)
+    os.makedirs(prefix_dir, exist_ok=True)
     with util.cwd(src_dir):
         with context.context(conf.context):
             with util.tee(settings.project_dep_install_log_filepath(conf.project, machine, conf.dependency, conf.recipe)) as tee:
@@ -95,24 +396,37 @@ def install(conf, machine):
                 print(click.style("*" * 80, fg=color), file=tee.stdin, flush=True)
                 env = os.environ.copy()
                 env["KOCHI_MACHINE"] = machine
-                env["KOCHI_INSTALL_PREFIX"] = dest_dir
+                env["KOCHI_INSTALL_PREFIX"] = prefix_dir
                 env.update(dep_envs)
                 env.update(conf.envs)
                 try:
-                    subprocess.run("\n".join(conf.activate_script + conf.script), env=env, shell=True, executable="/bin/bash",
+                    env, activate_script = activate(conf.project, machine, conf.recipe_dependencies, conf.activate_script, env, tee.stdin)
+                    subprocess.run("\n".join(activate_script + conf.script), env=env, shell=True, executable="/bin/bash",
                                    check=True, stdout=tee.stdin, stderr=tee.stdin)
                 except KeyboardInterrupt:
                     print(click.style("Kochi installation for {}:{} interrupted.".format(conf.dependency, conf.recipe), fg="red"), file=tee.stdin, flush=True)
                 except BaseException as e:
                     print(click.style("Kochi installation for {}:{} failed: {}".format(conf.dependency, conf.recipe, str(e)), fg="red"), file=tee.stdin, flush=True)
                 else:
-                    on_complete(conf, machine, env)
+                    on_complete(conf, machine, env, fingerprint)
+                    success = True
                 print(click.style("*" * 80, fg=color), file=tee.stdin, flush=True)
+    return success
+
+# Installation states loaded in this process, which are validated by the inode and mtime of the state file
+state_cache = dict()
 
 def get_state(project_name, dependency, recipe, machine):
+    filepath = settings.project_dep_install_state_filepath(project_name, machine, dependency, recipe)
     try:
-        with open(settings.project_dep_install_state_filepath(project_name, machine, dependency, recipe), "r") as f:
-            return util.deserialize(f.read())
+        st = os.stat(filepath)
+        signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if filepath in state_cache and state_cache[filepath][0] == signature:
+            return state_cache[filepath][1]
+        with open(filepath, "r") as f:
+            state = util.deserialize(f.read())
+        state_cache[filepath] = (signature, state)
+        return state
     except:
         raise Exception("Something went wrong with installation for dependency {}:{}. Try installing again.".format(dependency, recipe))
 
@@ -124,7 +438,7 @@ def show_detail(state, indent=0, **opts):
     table.append(["Executed on", "compute node" if state.on_machine else "login node"])
     table.append(["Context Ref", state.context.reference if state.context else None])
     table.append(["Context Commit Hash", state.commit_hash])
-    table.append(["Context Diff", state.context.diff if state.context else None])
+    table.append(["Context Diff", context.load_diff(state.context)])
     table.append(["Environment Variables", "\n".join(["{}={}".format(k, v) for k,v in state.envs.items()])])
     table.append(["Activate Script", "\n".join(state.activate_script)])
     table.append(["Script", "\n".join(state.script)])
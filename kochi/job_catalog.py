@@ -0,0 +1,71 @@
+from collections import namedtuple
+import os
+import fcntl
+
+from . import util
+from . import settings
+
+# A per-machine catalog of job states for listing jobs without opening a state file per job.
+#
+# - event log: append-only log of state transitions (one serialized event per line)
+# - index    : snapshot of all job entries folded from the event log up to some offset
+#
+# Event kinds:
+# - "enqueue", "start", "finish", "cancel": update the job entry with `fields` if the entry matches `cond`
+# - "import": fills fields missing in the job entry (used to backfill jobs not recorded in the catalog)
+Event = namedtuple("Event", ["kind", "job_id", "fields", "cond"])
+
+index_rebuild_threshold = 1024 * 1024
+
+def record_many(machine, events):
+    data = "".join([util.serialize(e) + "\n" for e in events])
+    with open(settings.job_catalog_log_filepath(machine), "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        f.write(data)
+
+def record(machine, kind, job_id, fields, cond=None):
+    record_many(machine, [Event(kind, job_id, fields, cond)])
+
+def apply_event(entries, event):
+    entry = entries.setdefault(event.job_id, dict())
+    if event.kind == "import":
+        for k, v in event.fields.items():
+            entry.setdefault(k, v)
+    elif not event.cond or all(entry.get(k) == v for k, v in event.cond.items()):
+        entry.update(event.fields)
+
+def load_index(machine):
+    try:
+        with open(settings.job_catalog_index_filepath(machine), "r") as f:
+            return util.deserialize(f.read())
+    except (FileNotFoundError, EOFError, ValueError):
+        return (0, dict())
+
+def save_index(machine, offset, entries):
+    filepath = settings.job_catalog_index_filepath(machine)
+    tmp_filepath = "{}.tmp.{}.{}".format(filepath, os.uname()[1], os.getpid())
+    with open(tmp_filepath, "w") as f:
+        f.write(util.serialize((offset, entries)))
+    os.replace(tmp_filepath, filepath)
+
+def load(machine):
+    """
+    Returns a dict of job entries (job ID -> dict of fields).
+    The index is rewritten when the part of the event log not folded into it grows large.
+    """
+    index_offset, entries = load_index(machine)
+    offset = index_offset
+    try:
+        with open(settings.job_catalog_log_filepath(machine), "rb") as f:
+            f.seek(offset)
+            for line in f:
+                # ignore an incomplete line being written
+                if not line.endswith(b"\n"):
+                    break
+                apply_event(entries, util.deserialize(line.decode()))
+                offset += len(line)
+    except FileNotFoundError:
+        return entries
+    if offset - index_offset > index_rebuild_threshold:
+        save_index(machine, offset, entries)
+    return entries
@@ -1,11 +1,11 @@
 import sys
 import collections
-import yaml
 
 loaded_config = dict()
 
 def root_config(path):
     global loaded_config
+    import yaml
     if not path in loaded_config:
         try:
             with open(path, "r") as f:
@@ -97,6 +97,15 @@ def run(path):
     run_conf.update(script=wrap_list(dict_get(run_conf, "script", default=[])))
     return run_conf
 
+# Resources
+# -----------------------------------------------------------------------------
+
+def resources(path, machine):
+    """
+    Returns resources (`cores` and `memory`) requested for each job, which are used by workers with multiple slots.
+    """
+    return parse_params({k: v for k, v in root_config(path).items() if k in ["cores", "memory"]}, machine, False)
+
 # Batches
 # -----------------------------------------------------------------------------
 
@@ -137,5 +146,10 @@ def batch_run(path, batch_name, machine):
     run_conf.update(script=wrap_list(dict_get(run_conf, "script", default=[])))
     return run_conf
 
+def batch_resources(path, batch_name, machine):
+    res = resources(path, machine)
+    res.update(parse_params({k: v for k, v in batch(path, batch_name).items() if k in ["cores", "memory"]}, machine, False))
+    return res
+
 def batch_artifacts(path, batch_name, machine):
     return dict_get(batch(path, batch_name), "artifacts", default=[])
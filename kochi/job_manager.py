@@ -13,7 +13,10 @@ from . import installer
 from . import atomic_counter
 from . import job_config
 from . import job_canceler
+from . import monitor
 from . import artifact
+from . import job_catalog
+from . import active_set
 
 class RunningState(enum.IntEnum):
     def __str__(self):
@@ -62,6 +65,7 @@ def on_start_job(job, worker_id, machine, envs, build_executed, build_params, bu
         f.seek(0)
         f.write(util.serialize(next_state))
         f.truncate()
+    job_catalog.record(machine, "start", job.id, dict(running_state=next_state.running_state, worker_id=worker_id, start_time=next_state.start_time))
 
 def on_finish_job(job, worker_id, machine, running_state):
     with open(settings.job_state_filepath(machine, job.id), "r+") as f:
@@ -70,6 +74,15 @@ def on_finish_job(job, worker_id, machine, running_state):
         f.seek(0)
         f.write(util.serialize(next_state))
         f.truncate()
+    job_catalog.record(machine, "finish", job.id, dict(running_state=running_state, latest_time=next_state.latest_time))
+    active_set.remove(settings.job_active_dirpath(machine), job.id)
+
+def activate(job, machine, env, stdout):
+    # The activate script sees the env of each phase (including params), so it is activated for each of them
+    if job.context:
+        return installer.activate(job.project_name, machine, job.dependencies, job.activate_script, env, stdout)
+    else:
+        return env, job.activate_script
 
 def run_job(job, worker_id, machine, queue_name, exec_build, stdout):
     build_success = False
@@ -97,17 +110,19 @@ def run_job(job, worker_id, machine, queue_name, exec_build, stdout):
             run_params = filter_params(job.params, job.run_conf.get("depend_params", []))
             run_env = env.copy()
             run_env.update(params2env(run_params))
-            # save job state
-            on_start_job(job, worker_id, machine, env, exec_build, build_params, build_script, run_params, run_script)
             try:
-                with job_canceler.job_canceler(machine, job.id):
+                # save job state (inside `try` so that the job is not left running if interrupted right after)
+                on_start_job(job, worker_id, machine, env, exec_build, build_params, build_script, run_params, run_script)
+                with monitor.watch_job(machine, job.id):
                     # build
                     if exec_build:
-                        subprocess.run("\n".join(job.activate_script + build_script), env=build_env, shell=True, executable="/bin/bash",
+                        build_env, activate_script = activate(job, machine, build_env, tee.stdin)
+                        subprocess.run("\n".join(activate_script + build_script), env=build_env, shell=True, executable="/bin/bash",
                                        stdout=tee.stdin, stderr=tee.stdin, check=True)
                         build_success = True
                     # run
-                    subprocess.run("\n".join(job.activate_script + run_script), env=run_env, shell=True, executable="/bin/bash",
+                    run_env, activate_script = activate(job, machine, run_env, tee.stdin)
+                    subprocess.run("\n".join(activate_script + run_script), env=run_env, shell=True, executable="/bin/bash",
                                    stdout=tee.stdin, stderr=tee.stdin, check=True)
             except KeyboardInterrupt:
                 if job_canceler.check_canceled(machine, job.id):
@@ -132,30 +147,74 @@ def run_job(job, worker_id, machine, queue_name, exec_build, stdout):
 
 def cancel(machine, job_id):
     job_canceler.cancel(machine, job_id)
+    # a waiting job is regarded as canceled immediately, while a running one is canceled when it finishes
+    job_catalog.record(machine, "cancel", job_id, dict(running_state=RunningState.CANCELED, latest_time=current_timestamp()),
+                       dict(running_state=RunningState.WAITING))
 
 def invalid_state():
     return State(*[RunningState.INVALID if f == "running_state" else None for f in state_fields])
 
+def resolve_state(machine, job_id, state, **opts):
+    if state.running_state == RunningState.WAITING:
+        if job_canceler.check_canceled(machine, job_id):
+            return update_state(state, running_state=RunningState.CANCELED)
+        else:
+            return state
+    elif state.running_state == RunningState.RUNNING:
+        worker_states = opts.get("worker_states", dict())
+        worker_state = worker_states[state.worker_id] if state.worker_id in worker_states else heartbeat.get_state(machine, state.worker_id)
+        if worker_state.running_state == heartbeat.RunningState.RUNNING:
+            return update_state(state, latest_time=current_timestamp())
+        else:
+            return update_state(state, running_state=RunningState.KILLED, latest_time=worker_state.latest_time)
+    else:
+        return state
+
 def get_state(machine, job_id):
     try:
         with open(settings.job_state_filepath(machine, job_id), "r") as f:
             state = util.deserialize(f.read())
-        if state.running_state == RunningState.WAITING:
-            if job_canceler.check_canceled(machine, job_id):
-                return update_state(state, running_state=RunningState.CANCELED)
-            else:
-                return state
-        elif state.running_state == RunningState.RUNNING:
-            worker_state = heartbeat.get_state(settings.worker_heartbeat_filepath(machine, state.worker_id))
-            if worker_state.running_state == heartbeat.RunningState.RUNNING:
-                return update_state(state, latest_time=current_timestamp())
-            else:
-                return update_state(state, running_state=RunningState.KILLED, latest_time=worker_state.latest_time)
-        else:
-            return state
+        return resolve_state(machine, job_id, state)
     except:
         return invalid_state()
 
+catalog_fields = ["running_state", "name", "queue", "worker_id", "init_time", "start_time", "latest_time"]
+
+def catalog_entry(state):
+    return {f: getattr(state, f) for f in catalog_fields}
+
+def state_of_catalog_entry(entry):
+    return State(*[entry.get(f) for f in state_fields])
+
+def get_catalog_states(machine, job_ids, **opts):
+    """
+    Returns a list of (job ID, state) of `job_ids` that match the filter (queues and names) from the newest.
+    States are taken from the job catalog, and only summary fields (`catalog_fields`) are available.
+    Jobs not yet recorded in the catalog (e.g., created by old versions) are read from state files and imported to the catalog.
+    """
+    queues = opts.get("queues", [])
+    names  = opts.get("names", [])
+    limit  = opts.get("limit", None)
+    entries = job_catalog.load(machine)
+    worker_states = heartbeat.get_all_states(machine)
+    results = []
+    imports = []
+    for job_id in sorted(job_ids, reverse=True):
+        if limit is not None and len(results) >= limit:
+            break
+        entry = entries.get(job_id)
+        if entry and entry.get("init_time") is not None:
+            state = resolve_state(machine, job_id, state_of_catalog_entry(entry), worker_states=worker_states)
+        else:
+            state = get_state(machine, job_id)
+            if state.running_state not in [RunningState.INVALID, RunningState.WAITING, RunningState.RUNNING]:
+                imports.append(job_catalog.Event("import", job_id, catalog_entry(state), None))
+        if (len(queues) == 0 or state.queue in queues) and (len(names) == 0 or state.name in names):
+            results.append((job_id, state))
+    if imports:
+        job_catalog.record_many(machine, imports)
+    return list(reversed(results))
+
 def parse_params(commands, machine):
     params = job_config.default_params(commands[0], machine)
     for param in commands[1:]:
@@ -187,13 +246,32 @@ def build_state(job, machine):
     build_script = job.build_conf.get("script", [])
     return dict(dependency_states=dep_states, context=job.context, params=build_params, build_script=build_script)
 
+def init_many(jobs, machine, queue_names):
+    events = []
+    for job, queue_name in zip(jobs, queue_names):
+        with open(settings.job_state_filepath(machine, job.id), "w") as f:
+            dep_states = get_dependency_states(job, machine)
+            state = State(RunningState.WAITING, job.name, queue_name, None, job.context, dep_states, None,
+                          job.artifacts_conf, job.activate_script, None, None, None, None, None,
+                          current_timestamp(), None, None)
+            f.write(util.serialize(state))
+        events.append(job_catalog.Event("enqueue", job.id, catalog_entry(state), None))
+    job_catalog.record_many(machine, events)
+    for job in jobs:
+        active_set.add(settings.job_active_dirpath(machine), job.id)
+
 def init(job, machine, queue_name):
-    with open(settings.job_state_filepath(machine, job.id), "w") as f:
-        dep_states = get_dependency_states(job, machine)
-        state = State(RunningState.WAITING, job.name, queue_name, None, job.context, dep_states, None,
-                      job.artifacts_conf, job.activate_script, None, None, None, None, None,
-                      current_timestamp(), None, None)
-        f.write(util.serialize(state))
+    init_many([job], machine, [queue_name])
+
+def wait(machine, job_id):
+    """
+    Waits for the job to finish and returns its final running state.
+    """
+    while True:
+        state = get_state(machine, job_id)
+        if not is_active(state):
+            return state.running_state
+        time.sleep(1)
 
 def ensure_init(machine):
     os.makedirs(settings.job_dirpath(machine), exist_ok=True)
@@ -201,7 +279,32 @@ def ensure_init(machine):
         atomic_counter.fetch(settings.job_counter_filepath(machine))
     except:
         atomic_counter.reset(settings.job_counter_filepath(machine))
+    active_set.ensure_init(settings.job_active_dirpath(machine), lambda: legacy_active_job_ids(machine))
+
+def is_active(state):
+    return state.running_state == RunningState.WAITING or state.running_state == RunningState.RUNNING
+
+def legacy_active_job_ids(machine):
     try:
-        atomic_counter.fetch(settings.job_min_active_filepath(machine))
+        min_jobs = atomic_counter.fetch(settings.job_min_active_filepath(machine))
     except:
-        atomic_counter.reset(settings.job_min_active_filepath(machine))
+        min_jobs = 0
+    max_jobs = atomic_counter.fetch(settings.job_counter_filepath(machine))
+    return [idx for idx in range(min_jobs, max_jobs) if is_active(get_state(machine, idx))]
+
+def get_active_states(machine, **opts):
+    """
+    Returns a list of (job ID, state) of active (waiting or running) jobs from the catalog.
+    Jobs found inactive (e.g., canceled while waiting or killed) are removed from the active set.
+    """
+    dirpath = settings.job_active_dirpath(machine)
+    job_states = []
+    for job_id, state in get_catalog_states(machine, active_set.list_all(dirpath)):
+        if is_active(state):
+            job_states.append((job_id, state))
+        else:
+            active_set.remove(dirpath, job_id)
+    queues = opts.get("queues", [])
+    names  = opts.get("names", [])
+    return [(job_id, state) for job_id, state in job_states
+            if (len(queues) == 0 or state.queue in queues) and (len(names) == 0 or state.name in names)]
@@ -1,5 +1,7 @@
 from collections import namedtuple
 import os
+import collections
+import contextlib
 
 from . import util
 from . import settings
@@ -7,18 +9,47 @@ from . import job_manager
 from . import locked_queue
 from . import atomic_counter
 from . import installer
+from . import doorbell
+from . import context
 
-Job = namedtuple("Job", ["name", "machine", "project_name", "queue", "dependencies", "context", "params", "artifacts_conf", "activate_script", "build_conf", "run_conf"])
-JobEnqueued = namedtuple("JobEnqueued", ["id", "name", "project_name", "dependencies", "context", "params", "artifacts_conf", "activate_script", "build_conf", "run_conf"])
+Job = namedtuple("Job", ["name", "machine", "project_name", "queue", "dependencies", "context", "params", "artifacts_conf", "activate_script", "build_conf", "run_conf", "resources"])
+JobEnqueued = namedtuple("JobEnqueued", ["id", "name", "project_name", "dependencies", "context", "params", "artifacts_conf", "activate_script", "build_conf", "run_conf", "resources"])
+# `resources` is optional for jobs created by old versions
+Job.__new__.__defaults__ = (dict(),)
+JobEnqueued.__new__.__defaults__ = (dict(),)
 
 def push(job):
-    if job.context:
-        installer.check_dependencies(job.project_name, job.machine, job.dependencies)
-    idx = atomic_counter.fetch_and_add(settings.job_counter_filepath(job.machine), 1)
-    job_enqueued = JobEnqueued(idx, job.name, job.project_name, job.dependencies, job.context, job.params, job.artifacts_conf, job.activate_script, job.build_conf, job.run_conf)
-    job_manager.init(job_enqueued, job.machine, job.queue)
-    locked_queue.push(settings.queue_filepath(job.machine, job.queue), util.serialize(job_enqueued))
-    return job_enqueued
+    return push_many([job])[0]
+
+def push_many(jobs):
+    """
+    Enqueues jobs for the same machine with a single reservation of job IDs and a single lock per queue.
+    """
+    if len(jobs) == 0:
+        return []
+    machine = jobs[0].machine
+    checked_deps = []
+    for job in jobs:
+        if job.context and (job.project_name, job.dependencies) not in checked_deps:
+            installer.check_dependencies(job.project_name, machine, job.dependencies)
+            checked_deps.append((job.project_name, job.dependencies))
+    stored_contexts = dict()
+    for job in jobs:
+        if job.context and job.context not in stored_contexts:
+            stored_contexts[job.context] = context.store(job.context)
+    idx_begin = atomic_counter.fetch_and_add(settings.job_counter_filepath(machine), len(jobs))
+    jobs_enqueued = []
+    entries = collections.OrderedDict()
+    for i, job in enumerate(jobs):
+        ctx = stored_contexts[job.context] if job.context else None
+        job_enqueued = JobEnqueued(idx_begin + i, job.name, job.project_name, job.dependencies, ctx, job.params, job.artifacts_conf, job.activate_script, job.build_conf, job.run_conf, job.resources)
+        entries.setdefault(job.queue, []).append(util.serialize(job_enqueued))
+        jobs_enqueued.append(job_enqueued)
+    job_manager.init_many(jobs_enqueued, machine, [job.queue for job in jobs])
+    for queue, queue_entries in entries.items():
+        locked_queue.push_many(settings.queue_filepath(machine, queue), queue_entries)
+        doorbell.ring(settings.queue_doorbell_filepath(machine, queue))
+    return jobs_enqueued
 
 def pop(machine, queue):
     try:
@@ -30,8 +61,32 @@ def pop(machine, queue):
     else:
         return None
 
+def pop_many(machine, queue, n):
+    try:
+        jobs_serialized = locked_queue.pop_many(settings.queue_filepath(machine, queue), n)
+    except FileNotFoundError:
+        return []
+    return [util.deserialize(j) for j in jobs_serialized]
+
+def push_front(machine, queue, jobs_enqueued):
+    """
+    Returns popped but unstarted jobs to the head of the queue.
+    """
+    if len(jobs_enqueued) > 0:
+        locked_queue.push_front(settings.queue_filepath(machine, queue), [util.serialize(j) for j in jobs_enqueued])
+        doorbell.ring(settings.queue_doorbell_filepath(machine, queue))
+
+@contextlib.contextmanager
+def watch(machine, queue, **opts):
+    """
+    Yields a function that blocks until a new job may have arrived in the queue (see `doorbell.watch` for `opts`).
+    """
+    with doorbell.watch(settings.queue_doorbell_filepath(machine, queue), **opts) as wait:
+        yield wait
+
 def ensure_init(machine):
     os.makedirs(settings.queue_dirpath(machine), exist_ok=True)
+    os.makedirs(settings.queue_doorbell_dirpath(machine), exist_ok=True)
 
 if __name__ == "__main__":
     """
@@ -1,21 +1,121 @@
+import os
 import fcntl
+import contextlib
 
-def push(filename, entry):
-    with open(filename, "a+") as f:
-        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-        f.write(entry + "\n")
+# Queue file format:
+#   header: "KOCHIQ <head offset>\n" (fixed length)
+#   body  : append-only entries, one per line
+# Entries before the head offset have already been popped.
+header_magic = b"KOCHIQ "
+header_size = len(header_magic) + 17
+compaction_threshold = 1024 * 1024
 
-def pop(filename):
-    result = None
-    with open(filename, "r+") as f:
+def encode_header(head):
+    return header_magic + "{:016d}\n".format(head).encode()
+
+def write_header(f, head):
+    f.seek(0)
+    f.write(encode_header(head))
+
+def read_header(f):
+    f.seek(0)
+    header = f.read(header_size)
+    if len(header) == 0:
+        write_header(f, header_size)
+        return header_size
+    elif header.startswith(header_magic) and len(header) == header_size:
+        return int(header[len(header_magic):])
+    else:
+        # convert a queue file of the legacy format (entries only)
+        f.seek(0)
+        body = f.read()
+        f.seek(0)
+        f.write(encode_header(header_size) + body)
+        f.truncate()
+        return header_size
+
+@contextlib.contextmanager
+def locked(filename, create=False):
+    flags = os.O_RDWR | os.O_CREAT if create else os.O_RDWR
+    with os.fdopen(os.open(filename, flags, 0o644), "r+b") as f:
         fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-        s = f.readlines()
-        if len(s) > 0:
-            result = s[0].split("\n")[0].rstrip("\x00")
-            f.seek(0)
-            f.writelines(s[1:])
+        yield f
+
+def compact(f, head):
+    """
+    Moves the unpopped entries to the front of the file.
+    Returns the new head offset.
+    """
+    f.seek(head)
+    body = f.read()
+    f.seek(header_size)
+    f.write(body)
+    f.truncate()
+    write_header(f, header_size)
+    return header_size
+
+def maybe_compact(f, head):
+    f.flush()
+    size = os.fstat(f.fileno()).st_size
+    if head >= size and head > header_size:
+        # the queue is empty; rewinding costs nothing (no write if already rewound)
+        f.truncate(header_size)
+        write_header(f, header_size)
+    elif head - header_size > compaction_threshold and head - header_size > size - head:
+        # amortized O(1) per pop because at least half of the file is garbage
+        compact(f, head)
+
+def decode_entry(line):
+    return line.decode().split("\n")[0].rstrip("\x00")
+
+def push_many(filename, entries):
+    with locked(filename, create=True) as f:
+        read_header(f)
+        f.seek(0, os.SEEK_END)
+        f.write("".join([e + "\n" for e in entries]).encode())
+
+def push(filename, entry):
+    push_many(filename, [entry])
+
+def push_front(filename, entries):
+    """
+    Puts entries back to the head of the queue (e.g., entries popped but not consumed).
+    """
+    data = "".join([e + "\n" for e in entries]).encode()
+    with locked(filename, create=True) as f:
+        head = read_header(f)
+        if head - header_size >= len(data):
+            head -= len(data)
+            f.seek(head)
+            f.write(data)
+        else:
+            f.seek(head)
+            body = f.read()
+            f.seek(header_size)
+            f.write(data + body)
             f.truncate()
-    return result
+            head = header_size
+        write_header(f, head)
+
+def pop_many(filename, n):
+    results = []
+    with locked(filename) as f:
+        head = read_header(f)
+        f.seek(head)
+        while len(results) < n:
+            line = f.readline()
+            if len(line) == 0:
+                break
+            results.append(decode_entry(line))
+            head += len(line)
+        if len(results) > 0:
+            write_header(f, head)
+        maybe_compact(f, head)
+    return results
+
+def pop(filename):
+    results = pop_many(filename, 1)
+    return results[0] if len(results) > 0 else None
 
 if __name__ == "__main__":
     """
@@ -29,7 +129,6 @@ if __name__ == "__main__":
     $ cat a1 a2 | sort -n | uniq | wc -l
     2000
     """
-    import os
     n = 1000
     filename = "test.lock"
     hostname = os.uname()[1]
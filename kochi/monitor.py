@@ -0,0 +1,91 @@
+import os
+import signal
+import threading
+import contextlib
+
+from . import heartbeat
+from . import job_canceler
+
+# A monitor thread running in each worker process, which
+# - periodically updates the heartbeat of the worker (less often while the worker state is unchanged)
+# - watches cancel requests for the jobs currently running on the worker
+#
+# The jobs being watched (job ID -> dict(machine, pgid, signaled)) are shared with the monitor thread via this module-level state.
+lock = threading.Lock()
+current_jobs = dict()
+
+def reinit_after_fork():
+    # The monitor thread does not exist in a forked child
+    global lock, current_jobs
+    lock = threading.Lock()
+    current_jobs = dict()
+
+os.register_at_fork(after_in_child=reinit_after_fork)
+
+def check_cancel():
+    with lock:
+        for job_id, job in current_jobs.items():
+            if not job["signaled"] and job_canceler.check_canceled(job["machine"], job_id):
+                # If the job runs in the worker's process group, the worker process itself receives SIGINT too,
+                # which raises KeyboardInterrupt in the main thread
+                try:
+                    os.killpg(job["pgid"], signal.SIGINT)
+                except ProcessLookupError:
+                    pass
+                job["signaled"] = True
+
+def current_job_id():
+    with lock:
+        return min(current_jobs) if current_jobs else None
+
+def add_job(machine, job_id, pgid):
+    with lock:
+        current_jobs[job_id] = dict(machine=machine, pgid=pgid, signaled=False)
+
+def remove_job(job_id):
+    with lock:
+        current_jobs.pop(job_id, None)
+
+def monitor_loop(stop_event, machine, worker_id, cancel_interval, min_heartbeat_interval, max_heartbeat_interval):
+    # The heartbeat interval grows while the worker keeps running the same job (or keeps idle)
+    heartbeat_interval = min_heartbeat_interval
+    job_id = current_job_id()
+    heartbeat.update_timestamp(machine, worker_id, heartbeat_interval, job_id=job_id)
+    elapsed = 0
+    while not stop_event.wait(cancel_interval):
+        elapsed += cancel_interval
+        check_cancel()
+        next_job_id = current_job_id()
+        if next_job_id != job_id:
+            heartbeat_interval = min_heartbeat_interval
+        elif elapsed >= heartbeat_interval:
+            heartbeat_interval = min(heartbeat_interval * 2, max_heartbeat_interval)
+        else:
+            continue
+        job_id = next_job_id
+        heartbeat.update_timestamp(machine, worker_id, heartbeat_interval, job_id=job_id)
+        elapsed = 0
+    heartbeat.update_timestamp(machine, worker_id, 0, job_id=None, state=heartbeat.RunningState.TERMINATED)
+
+@contextlib.contextmanager
+def monitor(machine, worker_id, **opts):
+    stop_event = threading.Event()
+    t = threading.Thread(target=monitor_loop, args=(stop_event, machine, worker_id, opts.get("cancel_interval", 0.5),
+                                                     opts.get("min_heartbeat_interval", 3), opts.get("max_heartbeat_interval", 60)), daemon=True)
+    t.start()
+    try:
+        yield
+    finally:
+        stop_event.set()
+        t.join()
+
+@contextlib.contextmanager
+def watch_job(machine, job_id):
+    """
+    Lets the monitor thread cancel the job `job_id` running in this process on request while in this context.
+    """
+    add_job(machine, job_id, os.getpgid(0))
+    try:
+        yield
+    finally:
+        remove_job(job_id)
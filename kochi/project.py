@@ -4,6 +4,8 @@ import subprocess
 from . import util
 from . import settings
 from . import config
+from . import ssh_connection
+from . import agent
 
 def project_name_of_cwd():
     return util.git_repo_name(util.toplevel_git_dirpath())
@@ -16,9 +18,31 @@ def get_all_recipes():
     return recipes
 
 def run_on_login_node(machine, script):
+    ret = agent.run(machine, script, capture=True)
+    if ret is not None:
+        code, stdout = ret
+        if code != 0:
+            raise subprocess.CalledProcessError(code, script)
+        return stdout.decode().strip()
     return util.run_command_ssh(config.login_host(machine), config.load_env_login_script(machine) + [script],
                                 cwd=config.work_dir(machine)).strip()
 
+# Remote paths of the project and commits already pushed are cached per machine in the git dir of the local repository,
+# so that enqueueing jobs does not need extra ssh round trips. Remove the cache file if the remote repository is recreated.
+def load_sync_cache(machine):
+    try:
+        with open(util.git_path("kochi_sync_{}".format(machine)), "r") as f:
+            return util.deserialize(f.read())
+    except (FileNotFoundError, EOFError, ValueError):
+        return dict(git_paths=dict(), commits=set())
+
+def save_sync_cache(machine, cache):
+    filepath = util.git_path("kochi_sync_{}".format(machine))
+    tmp_filepath = "{}.tmp.{}".format(filepath, os.getpid())
+    with open(tmp_filepath, "w") as f:
+        f.write(util.serialize(cache))
+    os.replace(tmp_filepath, filepath)
+
 def ensure_init(machine, project_name, is_artifact=False):
     os.makedirs(settings.project_dirpath(), exist_ok=True)
     if machine == "local":
@@ -27,19 +51,60 @@ def ensure_init(machine, project_name, is_artifact=False):
             subprocess.run(["git", "init", "-q", "--bare", local_git_path], check=True)
         return local_git_path
     else:
+        cache = load_sync_cache(machine)
+        if (project_name, is_artifact) in cache["git_paths"]:
+            return cache["git_paths"][(project_name, is_artifact)]
         is_artifact_opt = "--is-artifact" if is_artifact else ""
         try:
-            return run_on_login_node(machine, "kochi show path project -m local {} {}".format(is_artifact_opt, project_name))
+            remote_git_path = run_on_login_node(machine, "kochi show path project -m local {} {}".format(is_artifact_opt, project_name))
         except subprocess.CalledProcessError:
             remote_git_path = run_on_login_node(machine, "kochi show path project -m local -f {} {}".format(is_artifact_opt, project_name))
             run_on_login_node(machine, "[ -d {0} ] || git init -q --bare {0}".format(remote_git_path))
-            return remote_git_path
+        cache["git_paths"][(project_name, is_artifact)] = remote_git_path
+        save_sync_cache(machine, cache)
+        return remote_git_path
+
+def blob_dirpath(machine, project_name):
+    if machine == "local":
+        return settings.project_blob_dirpath(project_name)
+    else:
+        cache = load_sync_cache(machine)
+        blob_paths = cache.setdefault("blob_paths", dict())
+        if project_name in blob_paths:
+            return blob_paths[project_name]
+        remote_blob_path = run_on_login_node(machine, "kochi show path project -m local -f --is-blob {}".format(project_name))
+        blob_paths[project_name] = remote_blob_path
+        save_sync_cache(machine, cache)
+        return remote_blob_path
 
 def git_destination(machine, is_artifact=False):
     project_name = project_name_of_cwd()
     git_path = ensure_init(machine, project_name, is_artifact)
     return "{}:{}".format(config.login_host(machine), git_path) if machine != "local" else git_path
 
-def sync(machine):
+def git_ssh_env(machine):
+    # let git reuse the multiplexed ssh connection to the login node
+    env = os.environ.copy()
+    if machine != "local":
+        env["GIT_SSH_COMMAND"] = "ssh {}".format(ssh_connection.sshflags_str(config.login_host(machine)))
+    return env
+
+def context_ref(commit_hash):
+    # hidden from `git fetch` and `git clone` by default
+    return "refs/kochi/contexts/{}".format(commit_hash)
+
+def sync(machine, commit_hash=None):
+    """
+    Pushes the project to the machine.
+    If `commit_hash` is given, only that commit is pushed (as a hidden ref), unless it has already been pushed.
+    """
     destination = git_destination(machine)
-    subprocess.run(["git", "push", "-f", "-q", destination, "--all"], check=True)
+    if commit_hash:
+        cache = load_sync_cache(machine)
+        if commit_hash in cache["commits"]:
+            return
+        subprocess.run(["git", "push", "-f", "-q", destination, "{}:{}".format(commit_hash, context_ref(commit_hash))], env=git_ssh_env(machine), check=True)
+        cache["commits"].add(commit_hash)
+        save_sync_cache(machine, cache)
+    else:
+        subprocess.run(["git", "push", "-f", "-q", destination, "--all"], env=git_ssh_env(machine), check=True)
@@ -1,4 +1,5 @@
 import os
+import getpass
 
 from . import util
 
@@ -21,6 +22,12 @@ def queue_dirpath(machine):
 def queue_filepath(machine, queue_name):
     return os.path.join(queue_dirpath(machine), "{}.lock".format(queue_name))
 
+def queue_doorbell_dirpath(machine):
+    return os.path.join(root_path(), "doorbells", machine)
+
+def queue_doorbell_filepath(machine, queue_name):
+    return os.path.join(queue_doorbell_dirpath(machine), "{}.txt".format(queue_name))
+
 # Workers
 # -----------------------------------------------------------------------------
 
@@ -31,20 +38,40 @@ def worker_counter_filepath(machine):
     return os.path.join(worker_dirpath(machine), "counter.lock")
 
 def worker_min_active_filepath(machine):
+    # only used to migrate from the old versions
     return os.path.join(worker_dirpath(machine), "min_active.lock")
 
+def worker_active_dirpath(machine):
+    return os.path.join(worker_dirpath(machine), "active")
+
 def worker_log_filepath(machine, idx):
     return os.path.join(worker_dirpath(machine), "log_{}.txt".format(idx))
 
 def worker_workspace_dirpath(machine, idx):
     return os.path.join(worker_dirpath(machine), "workspace_{}".format(idx))
 
+def worker_scratch_dirpath(scratch_dir, machine, idx):
+    return os.path.join(scratch_dir, "kochi_{}".format(getpass.getuser()), machine, "workspace_{}".format(idx))
+
+def worker_scratch_filepath(machine, idx):
+    return os.path.join(worker_dirpath(machine), "scratch_{}.txt".format(idx))
+
+def worker_slot_dirpath(workspace_dirpath, slot):
+    return os.path.join(workspace_dirpath, "slot_{}".format(slot))
+
+def worker_checkout_dirpath(workspace_dirpath, checkout):
+    return os.path.join(workspace_dirpath, "checkout_{}".format(checkout))
+
 def worker_state_filepath(machine, idx):
     return os.path.join(worker_dirpath(machine), "state_{}.txt".format(idx))
 
 def worker_heartbeat_filepath(machine, idx):
+    # only used to read heartbeats of workers of old versions
     return os.path.join(worker_dirpath(machine), "heartbeat_{}.txt".format(idx))
 
+def worker_heartbeat_table_filepath(machine):
+    return os.path.join(worker_dirpath(machine), "heartbeat_table.bin")
+
 # Jobs
 # -----------------------------------------------------------------------------
 
@@ -55,8 +82,18 @@ def job_counter_filepath(machine):
     return os.path.join(job_dirpath(machine), "counter.lock")
 
 def job_min_active_filepath(machine):
+    # only used to migrate from the old versions
     return os.path.join(job_dirpath(machine), "min_active.lock")
 
+def job_active_dirpath(machine):
+    return os.path.join(job_dirpath(machine), "active")
+
+def job_catalog_log_filepath(machine):
+    return os.path.join(job_dirpath(machine), "catalog_log.txt")
+
+def job_catalog_index_filepath(machine):
+    return os.path.join(job_dirpath(machine), "catalog_index.txt")
+
 def job_log_filepath(machine, idx):
     return os.path.join(job_dirpath(machine), "log_{}.txt".format(idx))
 
@@ -78,6 +115,12 @@ def project_git_dirpath(project_name):
 def project_artifact_git_dirpath(project_name):
     return os.path.join(project_dirpath(), project_name, "artifact_git")
 
+def project_blob_dirpath(project_name):
+    return os.path.join(project_dirpath(), project_name, "blobs")
+
+def project_blob_filepath(project_name, blob_hash):
+    return os.path.join(project_blob_dirpath(project_name), blob_hash[:2], blob_hash[2:])
+
 def project_dep_install_dest_dirpath(project_name, machine, dep_name, recipe_name):
     return os.path.join(project_dirpath(), project_name, "install", machine, dep_name, recipe_name)
 
@@ -90,6 +133,30 @@ def project_dep_install_log_filepath(project_name, machine, dep_name, recipe_nam
 def project_dep_install_state_filepath(project_name, machine, dep_name, recipe_name):
     return os.path.join(project_dep_install_dest_dirpath(project_name, machine, dep_name, recipe_name), ".kochi_state.txt")
 
+def project_activate_env_filepath(project_name, machine, key):
+    return os.path.join(project_dirpath(), project_name, "install", machine, ".kochi_activate_env", "{}.txt".format(key))
+
+# Install cache
+# -----------------------------------------------------------------------------
+
+def install_cache_dirpath(machine):
+    return os.path.join(root_path(), "install_cache", machine)
+
+def install_cache_entry_dirpath(machine, fingerprint):
+    return os.path.join(install_cache_dirpath(machine), fingerprint)
+
+def install_cache_state_filepath(machine, fingerprint):
+    return os.path.join(install_cache_entry_dirpath(machine, fingerprint), ".kochi_state.txt")
+
+def install_cache_lock_filepath(machine, fingerprint):
+    return os.path.join(install_cache_dirpath(machine), "{}.lock".format(fingerprint))
+
+# Agent
+# -----------------------------------------------------------------------------
+
+def agent_socket_cache_filepath(machine):
+    return os.path.join(root_path(), "agents", "{}.txt".format(machine))
+
 # sshd
 # -----------------------------------------------------------------------------
 
@@ -142,5 +209,17 @@ def artifacts_master_branch():
 def artifacts_branch(machine):
     return "kochi_artifacts_{}".format(machine)
 
-def artifacts_dirpath(machine, project_name, worker_id):
-    return os.path.join(worker_workspace_dirpath(machine, worker_id), artifacts_dirname(machine, project_name))
+def artifacts_dirpath(machine):
+    return os.path.join(root_path(), "artifacts", machine)
+
+def artifacts_spool_dirpath(machine):
+    return os.path.join(artifacts_dirpath(machine), "spool")
+
+def artifacts_spool_entry_dirpath(machine, job_id):
+    return os.path.join(artifacts_spool_dirpath(machine), str(job_id))
+
+def artifacts_publisher_lock_filepath(machine):
+    return os.path.join(artifacts_dirpath(machine), "publisher.lock")
+
+def artifacts_publisher_dirpath(machine, project_name):
+    return os.path.join(artifacts_dirpath(machine), artifacts_dirname(machine, project_name))
@@ -0,0 +1,55 @@
+import os
+import subprocess
+import time
+import shlex
+import atexit
+import threading
+
+# A process-wide pool of multiplexed ssh connections (one ControlMaster per host).
+#
+# The master connection is established at the first ssh command to a host and is reused by all subsequent ssh
+# commands in this process. If $KOCHI_SSH_CONTROL_PERSIST is set (e.g., "10m"; see ControlPersist in ssh_config(5)),
+# the master is left running in background after the process exits and is reused by later kochi commands.
+control_path = os.path.join(os.path.expanduser("~"), ".ssh", "kochi-%r@%h:%p")
+
+lock = threading.Lock()
+masters = dict()
+
+def control_persist():
+    return os.environ.get("KOCHI_SSH_CONTROL_PERSIST")
+
+def is_master_running(host):
+    return subprocess.run(["ssh", "-o", "ControlPath={}".format(control_path), "-O", "check", host],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+def start_master(host, **opts):
+    timeout = opts.get("timeout", 30)
+    os.makedirs(os.path.dirname(control_path), exist_ok=True)
+    persist = control_persist()
+    if persist:
+        # ssh goes to background after authentication
+        subprocess.run(["ssh", "-f", "-N", "-T", "-o", "ControlMaster=yes", "-o", "ControlPath={}".format(control_path),
+                        "-o", "ControlPersist={}".format(persist), host], stderr=subprocess.DEVNULL)
+        return None
+    p = subprocess.Popen(["ssh", "-N", "-T", "-o", "ControlMaster=yes", "-o", "ControlPath={}".format(control_path), host],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    atexit.register(p.terminate)
+    t_end = time.time() + timeout
+    while p.poll() is None and time.time() < t_end:
+        if is_master_running(host):
+            break
+        time.sleep(0.05)
+    return p
+
+def sshflags(host):
+    """
+    Returns ssh options to run a command over the multiplexed connection to `host`, establishing it if needed.
+    Commands still work without the master connection (e.g., if it failed), as ssh falls back to a new connection.
+    """
+    with lock:
+        if host not in masters:
+            masters[host] = None if is_master_running(host) else start_master(host)
+    return ["-o", "ControlMaster=auto", "-o", "ControlPath={}".format(control_path)]
+
+def sshflags_str(host):
+    return " ".join([shlex.quote(f) for f in sshflags(host)])
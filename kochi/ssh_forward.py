@@ -1,4 +1,3 @@
-import os
 import subprocess
 import time
 import socket
@@ -7,31 +6,11 @@ import threading
 import urllib.request
 import webbrowser
 
-@contextlib.contextmanager
-def multiplexing_aux(dest):
-    control_path = os.path.join(os.path.expanduser("~"), ".ssh", "kochi-%r@%h:%p")
-    sshflags = ["-o", "ControlMaster=auto", "-o", "ControlPath={}".format(control_path), "-o", "ControlPersist=no"]
-    try:
-        subprocess.run(["ssh", *sshflags, "-O", "check", dest], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-    except subprocess.CalledProcessError:
-        with subprocess.Popen(["ssh", "-N", "-T", *sshflags, dest],
-                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) as p:
-            try:
-                yield sshflags
-            finally:
-                p.terminate()
-    else:
-        yield sshflags
+from . import ssh_connection
 
 @contextlib.contextmanager
 def multiplexing(dest):
-    try:
-        subprocess.run(["ssh", "-O", "check", dest], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-    except subprocess.CalledProcessError:
-        with multiplexing_aux(dest) as sshflags:
-            yield sshflags
-    else:
-        yield []
+    yield ssh_connection.sshflags(dest)
 
 def establish_remote_forward(local_port, dest, sshflags):
     max_retry = 10
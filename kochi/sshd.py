@@ -1,9 +1,9 @@
 import os
 import sys
+import shlex
 import subprocess
 import contextlib
 import shutil
-import psutil
 
 from . import util
 from . import settings
@@ -36,6 +36,7 @@ def sshd(machine, worker_id):
             try:
                 yield
             finally:
+                import psutil
                 for p in psutil.Process(sshd.pid).children(recursive=True):
                     p.kill()
                 sshd.kill()
@@ -49,7 +50,13 @@ def login_to_machine(machine, worker_id):
         print("sshd is not running with worker {} on machine {}.".format(worker_id, machine), file=sys.stderr)
         exit(1)
     try:
-        subprocess.run(["ssh", "-F", config_path, "kochi_worker"], check=True)
+        if os.path.isfile(settings.worker_scratch_filepath(machine, worker_id)):
+            # start a shell in the node-local workspace of the worker
+            with open(settings.worker_scratch_filepath(machine, worker_id), "r") as f:
+                scratch_dirpath = f.read().strip()
+            subprocess.run(["ssh", "-t", "-F", config_path, "kochi_worker", "cd {} && exec $SHELL -l".format(shlex.quote(scratch_dirpath))], check=True)
+        else:
+            subprocess.run(["ssh", "-F", config_path, "kochi_worker"], check=True)
     except subprocess.CalledProcessError:
         print("ssh to worker {} on machine {} failed.".format(worker_id, machine), file=sys.stderr)
         exit(1)
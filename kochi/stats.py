@@ -1,65 +1,41 @@
 import os
 import sys
 import datetime
-import tabulate
 
+from . import util
 from . import settings
 from . import atomic_counter
 from . import worker
 from . import job_manager
 from . import installer
+from . import context
+from . import active_set
+from . import artifact
+
+tabulate = util.lazy_import("tabulate")
 
 def get_all_worker_states(machine):
     max_workers = atomic_counter.fetch(settings.worker_counter_filepath(machine))
-    worker_states = []
-    for idx in range(max_workers):
-        state = worker.get_state(machine, idx)
-        worker_states.append((idx, state))
-    return worker_states
+    return worker.get_states(machine, range(max_workers))
 
 def get_all_active_worker_states(machine):
-    min_workers = atomic_counter.fetch(settings.worker_min_active_filepath(machine))
-    max_workers = atomic_counter.fetch(settings.worker_counter_filepath(machine))
-    min_updated = False
+    dirpath = settings.worker_active_dirpath(machine)
     worker_states = []
-    for idx in range(min_workers, max_workers):
-        state = worker.get_state(machine, idx)
-        if state.running_state == worker.RunningState.WAITING or \
-           state.running_state == worker.RunningState.RUNNING:
+    for idx, state in worker.get_states(machine, active_set.list_all(dirpath)):
+        if worker.is_active(state):
             worker_states.append((idx, state))
-            if not min_updated:
-                min_updated = True
-                if idx > min_workers:
-                    atomic_counter.reset(settings.worker_min_active_filepath(machine), idx)
+        else:
+            active_set.remove(dirpath, idx)
     return worker_states
 
-def get_all_job_states(machine, limit, show_all):
+def get_all_job_states(machine, limit, show_all, queues=[], names=[]):
     max_jobs = atomic_counter.fetch(settings.job_counter_filepath(machine))
-    if show_all:
-        limit = max_jobs
-    job_states = []
-    for idx in range(max(0, max_jobs - limit), max_jobs):
-        state = job_manager.get_state(machine, idx)
-        job_states.append((idx, state))
-    return job_states
+    return job_manager.get_catalog_states(machine, range(max_jobs), queues=queues, names=names,
+                                          limit=None if show_all else limit)
 
-def get_all_active_job_states(machine, limit, show_all):
-    min_jobs = atomic_counter.fetch(settings.job_min_active_filepath(machine))
-    max_jobs = atomic_counter.fetch(settings.job_counter_filepath(machine))
-    if show_all:
-        limit = max_jobs - min_jobs
-    min_updated = False
-    job_states = []
-    for idx in range(min_jobs, max_jobs):
-        state = job_manager.get_state(machine, idx)
-        if state.running_state == job_manager.RunningState.WAITING or \
-           state.running_state == job_manager.RunningState.RUNNING:
-            job_states.append((idx, state))
-            if not min_updated:
-                min_updated = True
-                if idx > min_jobs:
-                    atomic_counter.reset(settings.job_min_active_filepath(machine), idx)
-    return job_states[-limit:]
+def get_all_active_job_states(machine, limit, show_all, queues=[], names=[]):
+    job_states = job_manager.get_active_states(machine, queues=queues, names=names)
+    return job_states if show_all else job_states[max(0, len(job_states) - limit):]
 
 def show_queues(machine, **opts):
     queues = sorted(os.listdir(settings.queue_dirpath(machine)))
@@ -79,16 +55,15 @@ def show_workers(machine, show_all, queues, **opts):
     print(tabulate.tabulate(table, headers=["ID", "State", "Queue", "Created Time", "Start Time", "Running Time"]), file=opts.get("stdout", sys.stdout))
 
 def show_jobs(machine, show_terminated, limit, show_all, queues, names, **opts):
-    states = get_all_job_states(machine, limit, show_all) if show_terminated else get_all_active_job_states(machine, limit, show_all)
+    states = get_all_job_states(machine, limit, show_all, queues, names) if show_terminated else \
+             get_all_active_job_states(machine, limit, show_all, queues, names)
     table = []
     for idx, state in states:
-        if (len(queues) == 0 or state.queue in queues) and \
-           (len(names) == 0 or state.name in names):
-            init_dt   = datetime.datetime.fromtimestamp(state.init_time)   if state.init_time   else None
-            start_dt  = datetime.datetime.fromtimestamp(state.start_time)  if state.start_time  else None
-            latest_dt = datetime.datetime.fromtimestamp(state.latest_time) if state.latest_time else None
-            table.append([idx, state.name, str(state.running_state), state.queue, state.worker_id, init_dt, start_dt,
-                          latest_dt - start_dt if start_dt and latest_dt else None])
+        init_dt   = datetime.datetime.fromtimestamp(state.init_time)   if state.init_time   else None
+        start_dt  = datetime.datetime.fromtimestamp(state.start_time)  if state.start_time  else None
+        latest_dt = datetime.datetime.fromtimestamp(state.latest_time) if state.latest_time else None
+        table.append([idx, state.name, str(state.running_state), state.queue, state.worker_id, init_dt, start_dt,
+                      latest_dt - start_dt if start_dt and latest_dt else None])
     print(tabulate.tabulate(table, headers=["ID", "Name", "State", "Queue", "Worker ID", "Created Time", "Start Time", "Running Time"]), file=opts.get("stdout", sys.stdout))
 
 def show_job_detail(machine, job_id, **opts):
@@ -106,7 +81,7 @@ def show_job_detail(machine, job_id, **opts):
     table.append(["Running Time", latest_dt - start_dt if start_dt and latest_dt else None])
     table.append(["Context Project", state.context.project if state.context else None])
     table.append(["Context Ref", state.context.reference if state.context else None])
-    table.append(["Context Diff", state.context.diff if state.context else None])
+    table.append(["Context Diff", context.load_diff(state.context)])
     table.append(["Environment Variables", "\n".join(["{}={}".format(k, v) for k,v in state.envs.items()]) if state.envs else None])
     table.append(["Activate Script", "\n".join(state.activate_script) if state.activate_script else None])
     table.append(["Build Executed", state.build_executed])
@@ -137,6 +112,13 @@ def show_install_detail(machine, project_name, dependency, recipe, **opts):
     state = installer.get_state(project_name, dependency, recipe, machine)
     installer.show_detail(state, recurse=True, **opts)
 
+def show_pending_artifacts(machine, **opts):
+    table = []
+    for p in artifact.list_pending(machine):
+        table.append([p.job_id, p.job_name, p.project, datetime.datetime.fromtimestamp(p.queued_time)])
+    print(tabulate.tabulate(table, headers=["Job ID", "Name", "Project", "Queued Time"]), file=opts.get("stdout", sys.stdout))
+    print("\nPublisher: {}".format("running" if artifact.is_publishing(machine) else "idle"), file=opts.get("stdout", sys.stdout))
+
 def show_projects(**opts):
     projects = sorted(os.listdir(settings.project_dirpath()))
     for p in projects:
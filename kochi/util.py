@@ -10,11 +10,13 @@ import base64
 import contextlib
 import pathlib
 import urllib
-import graphlib
 import textwrap
-import pexpect
+import fcntl
+import importlib.util
 import click
 
+from . import ssh_connection
+
 def decorate_command(commands, **opts):
     cmds = ["export {}=\"{}\"".format(k, v) for k, v in opts.get("env").items() if v] if opts.get("env") else []
     if opts.get("cwd"):
@@ -23,19 +25,52 @@ def decorate_command(commands, **opts):
     return " && ".join(cmds)
 
 def run_command_ssh_expect(host, commands, send_commands, **opts):
-    p = pexpect.spawn("ssh -o LogLevel=QUIET -t {} '{}'".format(host, decorate_command(commands, **opts)))
+    import pexpect
+    p = pexpect.spawn("ssh -o LogLevel=QUIET {} -t {} '{}'".format(ssh_connection.sshflags_str(host), host, decorate_command(commands, **opts)))
     for c in send_commands:
         p.sendline(c)
     p.interact()
 
 def run_command_ssh_interactive(host, commands, **opts):
-    subprocess.run("ssh -o LogLevel=QUIET -t {} '{}'".format(host, decorate_command(commands, **opts)),
+    return subprocess.run("ssh -o LogLevel=QUIET {} -t {} '{}'".format(ssh_connection.sshflags_str(host), host, decorate_command(commands, **opts)),
                    shell=True, executable="/bin/bash")
 
+def run_command_ssh_input(host, commands, input_str, **opts):
+    return subprocess.run("ssh -o LogLevel=QUIET {} {} '{}'".format(ssh_connection.sshflags_str(host), host, decorate_command(commands, **opts)),
+                   shell=True, executable="/bin/bash", input=input_str, encoding="utf-8")
+
 def run_command_ssh(host, commands, **opts):
-    return subprocess.run("ssh -o LogLevel=QUIET {} '{}'".format(host, decorate_command(commands, **opts)),
+    return subprocess.run("ssh -o LogLevel=QUIET {} {} '{}'".format(ssh_connection.sshflags_str(host), host, decorate_command(commands, **opts)),
                           shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding="utf-8", check=True).stdout
 
+lazy_modules = []
+
+def lazy_import(name):
+    """
+    Returns the module `name` (e.g., "kochi.worker"), which is actually loaded when its attribute is first accessed.
+    Subsequent imports of the module elsewhere also get the lazy one until then.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    parent, _, child = name.rpartition(".")
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    lazy_modules.append(module)
+    return module
+
+def load_lazy_modules():
+    # loading a module may lazily import more modules
+    i = 0
+    while i < len(lazy_modules):
+        getattr(lazy_modules[i], "__name__")
+        i += 1
+
 def serialize(obj):
     return base64.b64encode(pickle.dumps(obj)).decode()
 
@@ -53,7 +88,9 @@ def cwd(path):
 
 @contextlib.contextmanager
 def tmpdir(path):
-    os.makedirs(path)
+    # a stale directory may be left by a crashed process (e.g., a worker with the same ID)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
     try:
         with cwd(path) as old_cwd:
             yield old_cwd
@@ -90,6 +127,13 @@ def is_inside_git_dir():
     except subprocess.CalledProcessError:
         return False
 
+def git_path(name):
+    """
+    Returns an absolute path to `name` in the git dir of the current repository (shared by all worktrees).
+    """
+    path = subprocess.run(["git", "rev-parse", "--git-common-dir"], stdout=subprocess.PIPE, encoding="utf-8", check=True).stdout.strip()
+    return os.path.join(os.path.abspath(path), name)
+
 def toplevel_git_dirpath():
     try:
         return subprocess.run(["git", "rev-parse", "--show-toplevel"], stdout=subprocess.PIPE, encoding="utf-8", check=True).stdout.strip()
@@ -125,6 +169,31 @@ def get_ip_address_candidates():
 def ensure_dir_exists(filepath):
     os.makedirs(os.path.dirname(filepath), exist_ok=True)
 
+@contextlib.contextmanager
+def flock(filepath, blocking=True):
+    """
+    Yields whether the lock was acquired (always True if `blocking`).
+    """
+    with open(filepath, "a") as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+        else:
+            yield True
+
+def parse_size(s):
+    """
+    Parses a size string such as '512M' or '4G' in bytes.
+    """
+    if isinstance(s, int):
+        return s
+    m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*", str(s), re.IGNORECASE)
+    if not m:
+        raise Exception("Invalid size: '{}'".format(s))
+    units = dict(K=1 << 10, M=1 << 20, G=1 << 30, T=1 << 40)
+    return int(float(m.group(1)) * units.get(m.group(2).upper(), 1))
+
 # params
 # -----------------------------------------------------------------------------
 
@@ -154,6 +223,7 @@ def param_substitute(params):
         )
         """.format(delim=delim, id=idpattern)
         param_substitute.regexp = re.compile(pattern, re.IGNORECASE | re.VERBOSE)
+    import graphlib
     ts = graphlib.TopologicalSorter()
     for k, v in params.items():
         depend_params = []
@@ -187,3 +257,46 @@ def param_product(params):
         else:
             param_pairs.append([(k, vl)])
     return [dict(d) for d in itertools.product(*param_pairs)]
+
+def run_dag(graph, run, jobs=1, **opts):
+    """
+    Calls `run(node)` for each node of `graph` ({node: prerequisite nodes}) in up to `jobs` threads.
+    A node is started as soon as all of its prerequisites succeed (`run` returns True), and is skipped if any of them fails.
+    Returns a list of failed nodes and a list of skipped nodes.
+    """
+    import graphlib
+    import concurrent.futures
+    name = opts.get("name", str)
+    ts = graphlib.TopologicalSorter(graph)
+    try:
+        ts.prepare()
+    except graphlib.CycleError as e:
+        cycle = " -> ".join([name(n) for n in e.args[1]])
+        click.secho("Dependencies have at least one cycle ({}).".format(cycle), fg="red", file=sys.stderr)
+        exit(1)
+    failed = []
+    skipped = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = dict()
+        while ts.is_active():
+            for node in ts.get_ready():
+                if any(p in failed or p in skipped for p in graph[node]):
+                    skipped.append(node)
+                    ts.done(node)
+                else:
+                    futures[executor.submit(run, node)] = node
+            if len(futures) == 0:
+                # dependents of skipped nodes may get ready
+                continue
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                node = futures.pop(f)
+                try:
+                    success = f.result()
+                except Exception as e:
+                    click.secho("{} failed: {}".format(name(node), str(e)), fg="red", file=sys.stderr)
+                    success = False
+                if not success:
+                    failed.append(node)
+                ts.done(node)
+    return failed, skipped
@@ -1,7 +1,11 @@
-from collections import namedtuple
+from collections import namedtuple, deque
 import os
 import time
 import copy
+import contextlib
+import signal
+import multiprocessing
+import multiprocessing.connection
 import click
 
 from . import util
@@ -13,6 +17,9 @@ from . import atomic_counter
 from . import context
 from . import sshd
 from . import heartbeat
+from . import active_set
+from . import monitor
+from . import artifact
 
 RunningState = heartbeat.RunningState
 state_fields = ["running_state", "queue", "init_time", "start_time", "latest_time"]
@@ -22,50 +29,287 @@ def get_worker_id(machine):
     idx = atomic_counter.fetch_and_add(settings.worker_counter_filepath(machine), 1)
     return idx
 
-def worker_loop(idx, queue_name, blocking, machine, stdout):
-    prev_job_build_state = dict()
-    while True:
-        job = job_queue.pop(machine, queue_name)
-        if job:
-            if not job_canceler.check_canceled(machine, job.id):
-                build_state = job_manager.build_state(job, machine)
-                exec_build = build_state != prev_job_build_state
-                build_success = job_manager.run_job(job, idx, machine, queue_name, exec_build, stdout)
-                if build_success:
-                    prev_job_build_state = build_state
-                elif exec_build:
-                    # The build environment can be in an inconsistent state
-                    prev_job_build_state = dict()
-        elif blocking:
-            time.sleep(0.1)
-        else:
-            return
+def prepare_context(dirpath, ctx):
+    # in a forked child process
+    os.makedirs(dirpath, exist_ok=True)
+    os.chdir(dirpath)
+    with context.context(ctx):
+        pass
+
+def worker_loop(idx, queue_name, blocking, machine, stdout, prefetch=1, pipeline=False):
+    # With `pipeline`, the worker alternates between two checkouts, and the context of the next job is
+    # deployed to the other checkout in background while the current job runs
+    checkout_dirpaths = [settings.worker_checkout_dirpath(os.getcwd(), i) for i in range(2)] if pipeline else [os.getcwd()]
+    current_checkout = 0
+    preparing = None # (job ID, checkout, process)
+    prev_job_build_states = dict()
+    # jobs claimed from the queue but not started yet
+    leased_jobs = deque()
+    mp_ctx = multiprocessing.get_context("fork")
+    try:
+        with contextlib.ExitStack() as stack:
+            wait_for_jobs = stack.enter_context(job_queue.watch(machine, queue_name)) if blocking else None
+            while True:
+                if len(leased_jobs) == 0:
+                    leased_jobs.extend(job_queue.pop_many(machine, queue_name, prefetch))
+                if len(leased_jobs) > 0:
+                    job = leased_jobs.popleft()
+                    if preparing:
+                        job_id, checkout, p = preparing
+                        p.join()
+                        preparing = None
+                        if job_id == job.id:
+                            # even if preparation failed, the context is deployed again when the job starts
+                            current_checkout = checkout
+                    if not job_canceler.check_canceled(machine, job.id):
+                        if pipeline:
+                            if len(leased_jobs) == 0:
+                                leased_jobs.extend(job_queue.pop_many(machine, queue_name, 1))
+                            if len(leased_jobs) > 0 and leased_jobs[0].context and leased_jobs[0].context != job.context:
+                                next_checkout = 1 - current_checkout
+                                p = mp_ctx.Process(target=prepare_context, args=(checkout_dirpaths[next_checkout], leased_jobs[0].context))
+                                p.start()
+                                preparing = (leased_jobs[0].id, next_checkout, p)
+                        build_state = job_manager.build_state(job, machine)
+                        exec_build = build_state != prev_job_build_states.get(current_checkout)
+                        os.makedirs(checkout_dirpaths[current_checkout], exist_ok=True)
+                        with util.cwd(checkout_dirpaths[current_checkout]):
+                            build_success = job_manager.run_job(job, idx, machine, queue_name, exec_build, stdout)
+                        check_stop_requested()
+                        if build_success:
+                            prev_job_build_states[current_checkout] = build_state
+                        elif exec_build:
+                            # The build environment can be in an inconsistent state
+                            prev_job_build_states.pop(current_checkout, None)
+                elif blocking:
+                    wait_for_jobs()
+                else:
+                    return
+    finally:
+        if preparing:
+            preparing[2].join()
+        # Do not lose prefetched jobs when the worker exits
+        job_queue.push_front(machine, queue_name, list(leased_jobs))
+
+# Slots
+# -----------------------------------------------------------------------------
+#
+# A worker with multiple slots runs jobs concurrently on one node.
+# Each job requests `cores` and `memory` (see job config), and the worker packs jobs into free cores in FIFO order.
+# Each job runs in a forked process pinned to a disjoint set of CPU cores, with its own checkout of the context.
+# Memory requests are only accounted (not enforced) to avoid oversubscription.
+
+Slot = namedtuple("Slot", ["idx", "job", "process", "cpus", "memory", "build_state", "exec_build"])
+
+def total_memory():
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError):
+        return None
+
+def job_resources(job, n_cpus, n_slots, mem_capacity):
+    res = job.resources if job.resources else dict()
+    cores = min(max(1, res.get("cores", max(1, n_cpus // n_slots))), n_cpus)
+    memory = res.get("memory", 0)
+    if mem_capacity is not None:
+        memory = min(memory, mem_capacity)
+    return cores, memory
+
+def run_job_in_slot(job, idx, slot_idx, cpus, machine, queue_name, exec_build, stdout):
+    # in a forked child process
+    os.setpgid(0, 0)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    os.sched_setaffinity(0, cpus)
+    artifact.defer_publish = True
+    slot_dirpath = settings.worker_slot_dirpath(os.getcwd(), slot_idx)
+    os.makedirs(slot_dirpath, exist_ok=True)
+    os.chdir(slot_dirpath)
+    build_success = job_manager.run_job(job, idx, machine, queue_name, exec_build, stdout)
+    os._exit(0 if build_success else 1)
 
-def start(queue_name, blocking, worker_id, machine):
-    with util.tmpdir(settings.worker_workspace_dirpath(machine, worker_id)):
-        with heartbeat.heartbeat(settings.worker_heartbeat_filepath(machine, worker_id)):
+def slot_worker_loop(idx, queue_name, blocking, machine, stdout, prefetch, n_slots):
+    all_cpus = sorted(os.sched_getaffinity(0))
+    mem_capacity = total_memory()
+    free_cpus = set(all_cpus)
+    free_memory = mem_capacity
+    free_slots = list(range(n_slots))
+    prev_job_build_states = dict()
+    running = dict() # process sentinel -> slot
+    leased_jobs = deque()
+    mp_ctx = multiprocessing.get_context("fork")
+
+    def reap(slot):
+        nonlocal free_memory
+        slot.process.join()
+        monitor.remove_job(slot.job.id)
+        free_cpus.update(slot.cpus)
+        if free_memory is not None:
+            free_memory += slot.memory
+        free_slots.append(slot.idx)
+        if slot.process.exitcode == 0:
+            prev_job_build_states[slot.idx] = slot.build_state
+        elif slot.exec_build or slot.process.exitcode < 0:
+            # The build environment can be in an inconsistent state
+            prev_job_build_states.pop(slot.idx, None)
+        if len(artifact.list_pending(machine)) > 0:
+            artifact.publish_async(machine)
+        if slot.process.exitcode != 0 and \
+           job_manager.get_state(machine, slot.job.id).running_state in (job_manager.RunningState.WAITING, job_manager.RunningState.RUNNING):
+            # failed before the job started (e.g., context deployment) or killed by a signal before the job state was saved
+            job_manager.on_finish_job(slot.job, idx, machine, job_manager.RunningState.ABORTED)
+
+    def try_dispatch(job):
+        nonlocal free_memory
+        cores, memory = job_resources(job, len(all_cpus), n_slots, mem_capacity)
+        if len(free_slots) == 0 or len(free_cpus) < cores or (free_memory is not None and free_memory < memory):
+            return False
+        slot_idx = free_slots.pop(0)
+        cpus = sorted(free_cpus)[:cores]
+        free_cpus.difference_update(cpus)
+        if free_memory is not None:
+            free_memory -= memory
+        build_state = job_manager.build_state(job, machine)
+        exec_build = build_state != prev_job_build_states.get(slot_idx)
+        p = mp_ctx.Process(target=run_job_in_slot, args=(job, idx, slot_idx, cpus, machine, queue_name, exec_build, stdout))
+        p.start()
+        try:
+            os.setpgid(p.pid, p.pid)
+        except OSError:
+            # the child has already called setpgid() or exited
+            pass
+        monitor.add_job(machine, job.id, p.pid)
+        running[p.sentinel] = Slot(slot_idx, job, p, cpus, memory, build_state, exec_build)
+        return True
+
+    try:
+        with contextlib.ExitStack() as stack:
+            wait_for_jobs = stack.enter_context(job_queue.watch(machine, queue_name))
+            while True:
+                check_stop_requested()
+                # FIFO: a job that does not fit blocks later jobs until enough resources are released
+                while True:
+                    if len(leased_jobs) == 0 and len(free_slots) > 0:
+                        leased_jobs.extend(job_queue.pop_many(machine, queue_name, prefetch))
+                    if len(leased_jobs) == 0:
+                        break
+                    if job_canceler.check_canceled(machine, leased_jobs[0].id):
+                        leased_jobs.popleft()
+                    elif try_dispatch(leased_jobs[0]):
+                        leased_jobs.popleft()
+                    else:
+                        break
+                if len(running) > 0:
+                    if len(leased_jobs) == 0 and len(free_slots) > 0:
+                        # wake up when either a new job arrives or a running job finishes
+                        wait_for_jobs(list(running))
+                        timeout = 0
+                    else:
+                        timeout = None
+                    for sentinel in multiprocessing.connection.wait(list(running), timeout):
+                        reap(running.pop(sentinel))
+                elif len(leased_jobs) > 0:
+                    # never fits even with all resources (should not happen because requests are clamped)
+                    raise Exception("Job {} cannot be run on this worker".format(leased_jobs[0].id))
+                elif blocking:
+                    wait_for_jobs()
+                else:
+                    return
+    finally:
+        job_queue.push_front(machine, queue_name, list(leased_jobs))
+        for slot in running.values():
+            try:
+                os.killpg(slot.process.pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+        for slot in list(running.values()):
+            reap(slot)
+
+# Set when the worker is requested to stop by SIGTERM
+stop_requested = False
+
+def on_sigterm(signum, frame):
+    # Batch schedulers terminate workers with SIGTERM (e.g., scancel or walltime limits).
+    # Raise KeyboardInterrupt to abort the current job (or waiting), and stop the worker after it, so that
+    # leased jobs are returned to the queue on the way out.
+    global stop_requested
+    stop_requested = True
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+def check_stop_requested():
+    # the KeyboardInterrupt may have been caught by the job being run
+    if stop_requested:
+        raise KeyboardInterrupt
+
+def start(queue_name, blocking, worker_id, machine, prefetch=1, slots=1, pipeline=False, scratch_dir=None):
+    signal.signal(signal.SIGTERM, on_sigterm)
+    try:
+        start_aux(queue_name, blocking, worker_id, machine, prefetch, slots, pipeline, scratch_dir)
+    finally:
+        active_set.remove(settings.worker_active_dirpath(machine), worker_id)
+
+@contextlib.contextmanager
+def scratch_workspace(machine, worker_id, scratch_dir):
+    """
+    Moves to a node-local workspace where checkouts and builds of jobs are placed.
+    Its location is recorded on the shared root so that `kochi inspect` can find it.
+    """
+    scratch_dirpath = settings.worker_scratch_dirpath(scratch_dir, machine, worker_id)
+    with util.tmpdir(scratch_dirpath):
+        with open(settings.worker_scratch_filepath(machine, worker_id), "w") as f:
+            f.write(scratch_dirpath)
+        try:
+            yield
+        finally:
+            os.remove(settings.worker_scratch_filepath(machine, worker_id))
+
+def start_aux(queue_name, blocking, worker_id, machine, prefetch, slots, pipeline, scratch_dir):
+    # The workspace on the shared root holds only small files for sshd if the scratch dir is specified
+    with util.tmpdir(settings.worker_workspace_dirpath(machine, worker_id)), \
+         scratch_workspace(machine, worker_id, scratch_dir) if scratch_dir else contextlib.ExitStack():
+        with monitor.monitor(machine, worker_id):
             with sshd.sshd(machine, worker_id):
                 with util.tee(settings.worker_log_filepath(machine, worker_id)) as tee:
                     color = "green"
                     print(click.style("Kochi worker {} started on machine {}.".format(worker_id, machine), fg=color), file=tee.stdin, flush=True)
                     print(click.style("=" * 80, fg=color), file=tee.stdin, flush=True)
                     try:
-                        worker_loop(worker_id, queue_name, blocking, machine, tee.stdin)
+                        if slots > 1:
+                            slot_worker_loop(worker_id, queue_name, blocking, machine, tee.stdin, prefetch, slots)
+                        else:
+                            worker_loop(worker_id, queue_name, blocking, machine, tee.stdin, prefetch, pipeline)
                     except KeyboardInterrupt:
                         print(click.style("Kochi worker {} interrupted.".format(worker_id), fg="red"), file=tee.stdin, flush=True)
                     except BaseException as e:
                         print(click.style("Kochi worker {} failed: {}".format(worker_id, str(e)), fg="red"), file=tee.stdin, flush=True)
+                    finally:
+                        artifact.wait_publishers()
                     print(click.style("=" * 80, fg=color), file=tee.stdin, flush=True)
 
-def get_state(machine, worker_id):
+def state_of_heartbeat(machine, worker_id, hb_state):
     try:
-        with open(settings.worker_state_filepath(machine, worker_id), "r") as f:
-            queue = f.read().strip()
-        hb_state = heartbeat.get_state(settings.worker_heartbeat_filepath(machine, worker_id))
+        if hb_state.running_state == RunningState.INVALID:
+            raise Exception("Invalid heartbeat")
+        if hb_state.queue:
+            queue = hb_state.queue
+        else:
+            with open(settings.worker_state_filepath(machine, worker_id), "r") as f:
+                queue = f.read().strip()
         return State(hb_state.running_state, queue, hb_state.init_time, hb_state.start_time, hb_state.latest_time)
     except:
         return State(RunningState.INVALID, None, None, None, None)
 
+def get_state(machine, worker_id):
+    return state_of_heartbeat(machine, worker_id, heartbeat.get_state(machine, worker_id))
+
+def get_states(machine, worker_ids):
+    """
+    Returns a list of (worker ID, state), reading the heartbeat table only once.
+    """
+    hb_states = heartbeat.get_all_states(machine)
+    return [(idx, state_of_heartbeat(machine, idx, hb_states[idx] if idx in hb_states else heartbeat.get_legacy_state(machine, idx)))
+            for idx in worker_ids]
+
 def watch(machine, worker_ids):
     if len(worker_ids) == 0:
         return
@@ -87,19 +331,28 @@ def init(machine, queue, worker_id):
         f.write(queue)
     with open(settings.worker_log_filepath(machine, worker_id), "w") as f:
         f.write("")
-    heartbeat.init(settings.worker_heartbeat_filepath(machine, worker_id))
+    heartbeat.init(machine, worker_id, queue)
+    active_set.add(settings.worker_active_dirpath(machine), worker_id)
     return worker_id
 
+def is_active(state):
+    return state.running_state == RunningState.WAITING or state.running_state == RunningState.RUNNING
+
+def legacy_active_worker_ids(machine):
+    try:
+        min_workers = atomic_counter.fetch(settings.worker_min_active_filepath(machine))
+    except:
+        min_workers = 0
+    max_workers = atomic_counter.fetch(settings.worker_counter_filepath(machine))
+    return [idx for idx in range(min_workers, max_workers) if is_active(get_state(machine, idx))]
+
 def ensure_init(machine):
     os.makedirs(settings.worker_dirpath(machine), exist_ok=True)
     try:
         atomic_counter.fetch(settings.worker_counter_filepath(machine))
     except:
         atomic_counter.reset(settings.worker_counter_filepath(machine))
-    try:
-        atomic_counter.fetch(settings.worker_min_active_filepath(machine))
-    except:
-        atomic_counter.reset(settings.worker_min_active_filepath(machine))
+    active_set.ensure_init(settings.worker_active_dirpath(machine), lambda: legacy_active_worker_ids(machine))
 
 if __name__ == "__main__":
     """
@@ -0,0 +1,26 @@
+import os
+import subprocess
+
+from kochi import artifact
+from kochi import blob
+
+def test_fetch_large_artifacts_of_machine(tmp_path, monkeypatch):
+    monkeypatch.setenv("KOCHI_ROOT", str(tmp_path / "kochi"))
+    worktree = tmp_path / "worktree"
+    worktree.mkdir()
+    monkeypatch.chdir(worktree)
+    subprocess.run(["git", "init", "-q"], check=True)
+    src = tmp_path / "trace.bin"
+    src.write_bytes(b"local trace")
+    os.makedirs("local")
+    artifact.write_pointer("local/trace.bin" + artifact.pointer_suffix, blob.put_file("proj", str(src)), src.stat().st_size)
+    # a pointer to the blob store of another machine
+    os.makedirs("otherhost")
+    artifact.write_pointer("otherhost/trace.bin" + artifact.pointer_suffix, "a" * 64, 10)
+
+    artifact.fetch_large_artifacts("local", "proj", 2)
+
+    assert (worktree / "local" / "trace.bin").read_bytes() == b"local trace"
+    assert not (worktree / "otherhost" / "trace.bin").exists()
+    status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=all"], stdout=subprocess.PIPE, encoding="utf-8", check=True).stdout
+    assert sorted(status.splitlines()) == ["?? local/trace.bin" + artifact.pointer_suffix, "?? otherhost/trace.bin" + artifact.pointer_suffix]
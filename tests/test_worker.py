@@ -0,0 +1,47 @@
+import os
+import time
+import signal
+import subprocess
+
+import pytest
+
+from kochi import job_queue
+from kochi import job_manager
+from kochi import worker
+
+@pytest.fixture
+def kochi_root(tmp_path, monkeypatch):
+    monkeypatch.setenv("KOCHI_ROOT", str(tmp_path / "kochi"))
+    monkeypatch.chdir(tmp_path)
+    for m in [worker, job_manager, job_queue]:
+        m.ensure_init("local")
+    return tmp_path
+
+def enqueue(queue, script):
+    return job_queue.push(job_queue.Job("test_job", "local", "proj", queue, dict(), None, dict(), [], [], dict(), dict(script=[script])))
+
+def queued_job_ids(queue):
+    # pops all jobs in the queue
+    return [j.id for j in job_queue.pop_many("local", queue, 100)]
+
+def wait_until(f, timeout=30):
+    t_end = time.time() + timeout
+    while time.time() < t_end:
+        if f():
+            return True
+        time.sleep(0.05)
+    return False
+
+def test_sigterm_returns_leased_jobs(kochi_root):
+    queue = "test"
+    jobs = [enqueue(queue, "sleep 30") for _ in range(4)]
+    p = subprocess.Popen(["kochi", "work", "-m", "local", "-q", queue, "--prefetch", "4"],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        assert wait_until(lambda: job_manager.get_state("local", jobs[0].id).running_state == job_manager.RunningState.RUNNING)
+        p.send_signal(signal.SIGTERM)
+        p.wait(timeout=30)
+    finally:
+        p.kill()
+    assert job_manager.get_state("local", jobs[0].id).running_state == job_manager.RunningState.ABORTED
+    assert queued_job_ids(queue) == [j.id for j in jobs[1:]]